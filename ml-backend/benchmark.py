@@ -0,0 +1,311 @@
+"""Бенчмарк генератора учебных планов на синтетических популяциях учеников.
+
+Примеры запуска:
+    python benchmark.py --out bench.json
+    python benchmark.py --out bench.json --baseline bench_baseline.json --threshold 0.15
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import main
+from main import (
+    DifficultyLevel,
+    LearningStyle,
+    StudyPlanResponse,
+    UserData,
+    advanced_generator,
+    build_study_plan_response,
+    generate_smart_recommendations,
+)
+
+SCORE_BANDS = {
+    'low': (10, 39),
+    'basic': (40, 59),
+    'medium': (60, 79),
+    'high': (80, 98)
+}
+
+# Горизонты подготовки в неделях: от месяца до двух лет
+HORIZONS_WEEKS = [4, 12, 26, 52, 104]
+
+# Горизонт, на котором замеряется сериализация ответа
+SERIALIZATION_WEEKS = 52
+
+STAGES = [
+    'context',
+    'topic_selection',
+    'weekly_plan',
+    'analytics',
+    'recommendations',
+    'full_plan',
+    'response_validate',
+    'response_serialize',
+    'response_serialize_legacy',
+    'api_generate_plan'
+]
+
+
+def build_population(seed: int, profiles_per_cell: int = 1,
+                     current_date: Optional[datetime] = None) -> List[UserData]:
+    """Воспроизводимая популяция: все сочетания диапазона баллов, сложности, стиля и горизонта"""
+    rnd = random.Random(seed)
+    current_date = current_date or datetime.now()
+    topic_names = list(main.CATALOG_INDEX.topics)
+    area_labels = topic_names + list(main.EGE_MATH_TOPICS) + ['Функции', 'Геометрия', 'Тригонометрия']
+
+    population = []
+    cells = itertools.product(SCORE_BANDS.items(), DifficultyLevel, LearningStyle, HORIZONS_WEEKS)
+    for (band, (low, high)), difficulty, style, weeks in cells:
+        for i in range(profiles_per_cell):
+            current_score = round(rnd.uniform(low, high), 1)
+            population.append(UserData(
+                userId=f"bench_{band}_{difficulty.value}_{style.value}_{weeks}w_{i}",
+                currentScore=current_score,
+                targetScore=min(100, round(current_score + rnd.uniform(5, 35), 1)),
+                # Сдвиг на 3 дня убирает зависимость числа недель от времени запуска
+                examDate=(current_date + timedelta(weeks=weeks, days=3)).isoformat(),
+                availableHoursPerWeek=rnd.choice([4, 6, 8, 10, 12, 15, 20]),
+                weakAreas=rnd.sample(area_labels, rnd.randint(0, 5)),
+                strongAreas=rnd.sample(topic_names, rnd.randint(0, 3)),
+                subject='math',
+                testResults={},
+                learningStyle=style,
+                preferredDifficulty=difficulty,
+                motivationLevel=rnd.randint(1, 10),
+                focusAreas=rnd.sample(topic_names, rnd.randint(0, 3))
+            ))
+    return population
+
+
+def _timed(samples: List[float], func: Callable[[], Any]) -> Any:
+    start = time.perf_counter()
+    result = func()
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+def time_generator_stages(population: List[UserData], repeats: int) -> Dict[str, List[float]]:
+    """Время каждого этапа генерации отдельно, в секундах"""
+    generator = advanced_generator
+    samples: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+
+    for _ in range(repeats):
+        for user_data in population:
+            ctx = _timed(samples['context'], lambda: generator.build_context(user_data))
+            schedule = _timed(samples['topic_selection'],
+                              lambda: generator.optimize_topic_selection(ctx))
+            if ctx.advanced:
+                _timed(samples['weekly_plan'],
+                       lambda: generator.create_focused_weekly_plan(schedule, ctx))
+            else:
+                _timed(samples['weekly_plan'],
+                       lambda: generator.create_personalized_weekly_plan(schedule, ctx))
+            _timed(samples['analytics'],
+                   lambda: generator._generate_plan_analytics(schedule, ctx))
+            plan = _timed(samples['full_plan'],
+                          lambda: generator.generate_advanced_study_plan(user_data))
+            _timed(samples['recommendations'],
+                   lambda: generate_smart_recommendations(user_data, plan))
+    return samples
+
+
+class LegacyPlanResponse(StudyPlanResponse):
+    """Прежняя форма ответа: план как нетипизированный словарь"""
+    plan: Dict[str, Any]
+
+
+def time_serialization(population: List[UserData], repeats: int) -> Dict[str, List[float]]:
+    """Сборка и сериализация ответа для планов на SERIALIZATION_WEEKS недель.
+
+    response_validate - построение типизированных моделей из словаря плана,
+    response_serialize - model_dump_json, как в API,
+    response_serialize_legacy - прежний путь: проверка response_model в FastAPI и json.dumps
+    нетипизированного ответа.
+    """
+    samples: Dict[str, List[float]] = {
+        'response_validate': [], 'response_serialize': [], 'response_serialize_legacy': []
+    }
+    users = [user_data for user_data in population if user_data.userId.endswith(f"_{SERIALIZATION_WEEKS}w_0")]
+    responses = [build_study_plan_response(advanced_generator, user_data) for user_data in users]
+    payloads = [response.model_dump(exclude_none=True) for response in responses]
+    legacy_responses = [LegacyPlanResponse.model_validate(payload) for payload in payloads]
+    legacy_field = create_response_field(name='response', type_=LegacyPlanResponse, mode='serialization')
+    loop = asyncio.new_event_loop()
+
+    def legacy_encode(legacy_response: LegacyPlanResponse) -> bytes:
+        content = loop.run_until_complete(
+            serialize_response(field=legacy_field, response_content=legacy_response, is_coroutine=True)
+        )
+        return json.dumps(content, ensure_ascii=False).encode('utf-8')
+
+    try:
+        for _ in range(repeats):
+            for response, payload, legacy_response in zip(responses, payloads, legacy_responses):
+                _timed(samples['response_validate'], lambda: StudyPlanResponse.model_validate(payload))
+                _timed(samples['response_serialize'], lambda: response.model_dump_json(exclude_none=True))
+                _timed(samples['response_serialize_legacy'], lambda: legacy_encode(legacy_response))
+    finally:
+        loop.close()
+    return samples
+
+
+async def _asgi_post(app, path: str, body: bytes) -> int:
+    """Минимальный вызов ASGI-приложения в процессе, без сетевого стека"""
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'POST',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('127.0.0.1', 8000)
+    }
+    status = 0
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            await asyncio.sleep(3600)
+        request_sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
+
+
+def time_api_path(population: List[UserData], repeats: int) -> List[float]:
+    """Время полного пути /generate-plan через ASGI-приложение (кэш планов сбрасывается)"""
+    bodies = [user_data.model_dump_json().encode('utf-8') for user_data in population]
+    samples: List[float] = []
+
+    async def run():
+        for _ in range(repeats):
+            for body in bodies:
+                main.plan_cache.invalidate()
+                start = time.perf_counter()
+                status = await _asgi_post(main.app, '/generate-plan', body)
+                samples.append(time.perf_counter() - start)
+                if status != 200:
+                    raise RuntimeError(f"/generate-plan вернул {status}")
+
+    asyncio.run(run())
+    return samples
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    values_ms = np.asarray(samples) * 1000
+    return {
+        'n': int(values_ms.size),
+        'mean_ms': float(values_ms.mean()),
+        'p50_ms': float(np.percentile(values_ms, 50)),
+        'p95_ms': float(np.percentile(values_ms, 95)),
+        'max_ms': float(values_ms.max()),
+        'total_ms': float(values_ms.sum())
+    }
+
+
+def run_benchmark(seed: int, profiles_per_cell: int, repeats: int, include_api: bool = True) -> Dict[str, Any]:
+    population = build_population(seed, profiles_per_cell)
+    samples = time_generator_stages(population, repeats)
+    samples.update(time_serialization(population, repeats))
+    if include_api:
+        samples['api_generate_plan'] = time_api_path(population, repeats)
+
+    return {
+        'meta': {
+            'seed': seed,
+            'profiles': len(population),
+            'repeats': repeats,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'timestamp': datetime.now().isoformat()
+        },
+        'stages': {stage: summarize(values) for stage, values in samples.items() if values}
+    }
+
+
+def compare_with_baseline(results: Dict[str, Any], baseline: Dict[str, Any],
+                          threshold: float, metric: str = 'p50_ms') -> List[Dict[str, Any]]:
+    """Сравнение этапов с базовой линией; регрессия - рост метрики больше порога"""
+    comparison = []
+    for stage, stats in results['stages'].items():
+        base_stats = baseline.get('stages', {}).get(stage)
+        if not base_stats or not base_stats.get(metric):
+            continue
+        ratio = stats[metric] / base_stats[metric]
+        comparison.append({
+            'stage': stage,
+            'baseline': base_stats[metric],
+            'current': stats[metric],
+            'ratio': ratio,
+            'regression': ratio > 1 + threshold
+        })
+    return comparison
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк AdaptiveStudyPlanGenerator")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--profiles-per-cell', type=int, default=1,
+                        help="число учеников на каждое сочетание балла, сложности, стиля и горизонта")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--skip-api', action='store_true', help="не замерять путь через ASGI")
+    parser.add_argument('--out', help="файл для результатов в JSON (по умолчанию stdout)")
+    parser.add_argument('--baseline', help="JSON с результатами базового прогона")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="допустимый относительный рост времени этапа (0.10 = 10%%)")
+    parser.add_argument('--metric', default='p50_ms', choices=['mean_ms', 'p50_ms', 'p95_ms'])
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.INFO)
+    results = run_benchmark(args.seed, args.profiles_per_cell, args.repeats, include_api=not args.skip_api)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        comparison = compare_with_baseline(results, baseline, args.threshold, args.metric)
+        results['comparison'] = {'metric': args.metric, 'threshold': args.threshold, 'stages': comparison}
+        for row in comparison:
+            marker = 'REGRESSION' if row['regression'] else 'ok'
+            print(f"{row['stage']:20s} {row['baseline']:9.3f} -> {row['current']:9.3f} ms "
+                  f"(x{row['ratio']:.2f}) {marker}", file=sys.stderr)
+        if any(row['regression'] for row in comparison):
+            exit_code = 1
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,21 +1,57 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import StreamingResponse, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, Field
+from typing import Annotated, AsyncIterator, List, Dict, Any, Optional, Union, Mapping, Tuple, FrozenSet, Iterator, Callable, Awaitable
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
 from enum import Enum
+from types import MappingProxyType
+from dataclasses import dataclass, replace
 import json
+import math
+import os
+import sys
+import heapq
+import itertools
+import hashlib
+import hmac
+import threading
+import time
+import bisect
+import re
+import cProfile
+import pstats
+from collections import OrderedDict, deque
+from functools import lru_cache
+from contextlib import asynccontextmanager
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+# MessagePack необязателен: без него ответы всегда отдаются в JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Жизненный цикл приложения: при остановке закрываются пулы исполнителей генерации"""
+    yield
+    shutdown_plan_executors()
+
 app = FastAPI(
     title="Advanced EGE Trainer ML API", 
     version="2.0.0",
-    description="Умный генератор учебных планов для подготовки к ЕГЭ с адаптивным ML"
+    description="Умный генератор учебных планов для подготовки к ЕГЭ с адаптивным ML",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -27,6 +63,57 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Исполнитель для генерации планов: thread | process | inline.
+# В режиме inline генерация выполняется прямо в цикле событий (как раньше).
+PLAN_EXECUTOR_MODE = os.getenv("PLAN_EXECUTOR_MODE", "thread").lower()
+PLAN_EXECUTOR_WORKERS = int(os.getenv("PLAN_EXECUTOR_WORKERS", str(min(4, os.cpu_count() or 1))))
+if PLAN_EXECUTOR_MODE not in ("thread", "process", "inline"):
+    raise ValueError(f"Неизвестный PLAN_EXECUTOR_MODE: {PLAN_EXECUTOR_MODE}")
+
+# Настройки кэша планов (размер 0 отключает кэш)
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "1024"))
+PLAN_CACHE_TTL = float(os.getenv("PLAN_CACHE_TTL", "600"))
+
+# Хранилище выданных планов по planId для перепланирования (/replan)
+PLAN_STORE_SIZE = int(os.getenv("PLAN_STORE_SIZE", "512"))
+PLAN_STORE_TTL = float(os.getenv("PLAN_STORE_TTL", str(14 * 24 * 3600)))
+
+# Профилирование отдельных запросов (заголовок X-Profile-Plan или ?profile=true).
+# Без PLAN_PROFILING_ENABLED флаги запроса игнорируются.
+PLAN_PROFILING_ENABLED = os.getenv("PLAN_PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+PLAN_PROFILE_DIR = os.getenv("PLAN_PROFILE_DIR", "")
+PLAN_PROFILE_TOP = int(os.getenv("PLAN_PROFILE_TOP", "30"))
+
+# Число смоделированных траекторий для перцентилей прогресса баллов (progressBands)
+PROGRESSION_SIMULATIONS = int(os.getenv("PROGRESSION_SIMULATIONS", "1000"))
+
+# Максимум вариантов (часы x цели) в одном запросе /generate-plan/sweep
+SWEEP_MAX_VARIANTS = int(os.getenv("SWEEP_MAX_VARIANTS", "400"))
+
+# Таблица вероятности успеха из Монте-Карло симуляции (python main.py simulate).
+# Без таблицы используется ступенчатая оценка.
+SUCCESS_TABLE_PATH = os.getenv("SUCCESS_TABLE_PATH", "")
+SIMULATION_STUDENTS = int(os.getenv("SIMULATION_STUDENTS", "1000"))
+SIMULATION_BATCH_TRAJECTORIES = int(os.getenv("SIMULATION_BATCH_TRAJECTORIES", "500000"))
+SIMULATION_MAX_TRAJECTORIES = int(os.getenv("SIMULATION_MAX_TRAJECTORIES", "5000000"))
+# Наибольший горизонт оси weeks: симуляция делает по шагу на каждую неделю до максимума оси
+SIMULATION_MAX_WEEKS = int(os.getenv("SIMULATION_MAX_WEEKS", "260"))
+# Размер таблицы /simulate: точек на одной оси и узлов всей сетки
+SIMULATION_MAX_AXIS_POINTS = int(os.getenv("SIMULATION_MAX_AXIS_POINTS", "50"))
+SIMULATION_MAX_NODES = int(os.getenv("SIMULATION_MAX_NODES", "200000"))
+# Токен для /simulate с activate=true (заголовок X-Admin-Token); без него активация отключена
+SIMULATION_ACTIVATE_TOKEN = os.getenv("SIMULATION_ACTIVATE_TOKEN", "")
+
+# Размер кэша сопоставления слабых областей с темами каталога
+WEAK_AREA_CACHE_SIZE = int(os.getenv("WEAK_AREA_CACHE_SIZE", "4096"))
+
+# Настройки пакетной генерации планов
+BATCH_MAX_WORKERS = int(os.getenv("PLAN_BATCH_WORKERS", str(os.cpu_count() or 1)))
+BATCH_CHUNK_SIZE = int(os.getenv("PLAN_BATCH_CHUNK_SIZE", "16"))
+BATCH_MAX_USERS = int(os.getenv("PLAN_BATCH_MAX_USERS", "10000"))
+# Офлайн-генерация из выгрузки (python main.py bulk): строк за одно чтение файла
+BULK_READ_ROWS = int(os.getenv("PLAN_BULK_READ_ROWS", "1000"))
+
 # Расширенные модели данных
 class LearningStyle(str, Enum):
     VISUAL = "visual"
@@ -39,6 +126,10 @@ class DifficultyLevel(str, Enum):
     INTERMEDIATE = "intermediate"
     ADVANCED = "advanced"
 
+class SelectionMode(str, Enum):
+    GREEDY = "greedy"        # три прохода по убыванию приоритета
+    KNAPSACK = "knapsack"    # оптимальный выбор тем динамикой по бюджету часов
+
 class UserData(BaseModel):
     userId: str
     currentScore: float
@@ -54,16 +145,212 @@ class UserData(BaseModel):
     previousExperience: Optional[str] = ""
     motivationLevel: Optional[int] = 7  # 1-10
     focusAreas: Optional[List[str]] = []
+    progressBands: Optional[bool] = False  # перцентили p10/p50/p90 в estimatedScoreProgress
+    selectionMode: Optional[SelectionMode] = SelectionMode.GREEDY
+
+# Типизированная структура плана: сериализуется pydantic-core без обхода Dict[str, Any]
+class TopicAllocation(BaseModel):
+    allocated_hours: int
+    priority: float
+    category: str
+    week_distribution: List[Any] = []
+    complexity: int
+
+class FocusTopic(BaseModel):
+    name: str
+    hours: int
+    category: str
+    priority: float
+    complexity: Optional[int] = None
+
+class LearningActivity(BaseModel):
+    type: str
+    duration: int
+    methods: List[str]
+    resources: Optional[List[str]] = None
+    description: Optional[str] = None
+    exercises: Optional[str] = None
+    difficulty: Optional[str] = None
+    sources: Optional[List[str]] = None
+
+class PracticeTest(BaseModel):
+    type: str
+    topics: Union[List[str], str]
+    duration: int
+    difficulty: Optional[str] = None
+
+class WeekPlan(BaseModel):
+    weekNumber: int
+    focusTopics: List[FocusTopic]
+    totalHours: int
+    dailyBreakdown: Optional[List[Any]] = None
+    learningActivities: List[LearningActivity]
+    goals: List[str]
+    practiceTests: List[PracticeTest]
+    resources: List[str]
+    successMetrics: Optional[List[Any]] = None
+    intensity: Optional[str] = None
+
+class Milestone(BaseModel):
+    week: int
+    targetScore: int
+    description: str
+    type: str
+    keyTopics: List[str]
+
+class ResourceGroup(BaseModel):
+    category: str
+    items: List[str]
+
+class LearningGaps(BaseModel):
+    critical: List[str]
+    significant: List[str]
+    minor: List[str]
+
+class StudyFocus(BaseModel):
+    priorityTopics: List[str]
+    strongAreas: List[str]
+    learningGaps: LearningGaps
+    recommendedApproach: str
+    learningStrategy: Dict[str, List[str]]
+    planType: str
+    studentLevel: str
+
+class CoverageMetrics(BaseModel):
+    criticalGapsCovered: str
+    totalTopicsCovered: int
+    totalHoursAllocated: int
+
+class PlanAnalytics(BaseModel):
+    planEfficiency: float
+    coverageMetrics: CoverageMetrics
+    difficultyDistribution: Dict[str, int]
+    riskAssessment: List[str]
+    successProbability: float
+
+class ScorePoint(BaseModel):
+    week: int
+    estimatedScore: float
+    confidence: float
+    p10: Optional[float] = None
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+
+class ReplanInfo(BaseModel):
+    basePlanId: Optional[str] = None
+    completedWeeks: int
+    changedTopics: List[str]
+
+class StudyPlan(BaseModel):
+    planId: str
+    durationWeeks: int
+    totalStudyHours: int
+    topicDistribution: Dict[str, TopicAllocation]
+    studyFocus: StudyFocus
+    resources: List[ResourceGroup]
+    resourceCatalog: Dict[str, str] = {}   # идентификатор ресурса -> название, на них ссылаются недели
+    milestones: List[Milestone]
+    totalTopics: int
+    averageHoursPerWeek: int
+    analytics: PlanAnalytics
+    estimatedScoreProgress: List[ScorePoint]
+    weeklySchedule: List[WeekPlan]
+    replan: Optional[ReplanInfo] = None
 
 class StudyPlanResponse(BaseModel):
     success: bool
-    plan: Dict[str, Any]
+    plan: StudyPlan
     recommendations: List[str]
     confidence: float
     generatedBy: str
     planId: Optional[str] = None
     analytics: Optional[Dict[str, Any]] = None
 
+class ReplanRequest(BaseModel):
+    planId: Optional[str] = None
+    plan: Optional[StudyPlan] = None       # тело прежнего плана, если его нет в хранилище
+    userData: Optional[UserData] = None    # данные, по которым строился прежний план
+    completedWeeks: int
+    testResults: Dict[str, Any] = {}
+    currentScore: Optional[float] = None   # по умолчанию testResults.estimatedScore
+    weakAreas: Optional[List[str]] = None
+    strongAreas: Optional[List[str]] = None
+
+class StoredPlan(BaseModel):
+    # Запись plan_store: план и данные, по которым он построен (хранится как JSON)
+    plan: StudyPlan
+    userData: UserData
+
+class BatchPlanRequest(BaseModel):
+    # Пользователи проверяются по одному: ошибка в одном не отклоняет весь пакет
+    users: List[Dict[str, Any]]
+
+class BatchPlanItem(BaseModel):
+    userId: str
+    success: bool
+    result: Optional[StudyPlanResponse] = None
+    error: Optional[str] = None
+
+class BatchPlanSummary(BaseModel):
+    """Последняя строка потока /generate-plans/batch"""
+    success: bool
+    total: int
+    succeeded: int
+    failed: int
+    processingTime: float
+
+class SweepRequest(BaseModel):
+    profile: UserData
+    hoursPerWeek: Optional[List[int]] = None    # по умолчанию - часы из профиля
+    targetScores: Optional[List[float]] = None  # по умолчанию - цель из профиля
+
+class SweepResponse(BaseModel):
+    success: bool
+    userId: str
+    durationWeeks: int
+    # Матрицы: строки соответствуют hoursPerWeek, столбцы - targetScores
+    hoursPerWeek: List[int]
+    targetScores: List[float]
+    topicsCovered: List[List[int]]
+    studyHours: List[List[int]]
+    # Только с таблицей симуляции: ступенчатая оценка не зависит от часов в неделю,
+    # и строки матрицы совпадали бы при любом бюджете времени
+    successProbability: Optional[List[List[float]]] = None
+    processingTime: float
+
+class SimulationRequest(BaseModel):
+    # Оси сетки; не заданные берутся из SIMULATION_GRID
+    currentScores: Optional[List[float]] = Field(None, max_length=SIMULATION_MAX_AXIS_POINTS)
+    targetScores: Optional[List[float]] = Field(None, max_length=SIMULATION_MAX_AXIS_POINTS)
+    hoursPerWeek: Optional[List[float]] = Field(None, max_length=SIMULATION_MAX_AXIS_POINTS)
+    weeks: Optional[List[Annotated[int, Field(strict=True, ge=1, le=SIMULATION_MAX_WEEKS)]]] = Field(
+        None, max_length=SIMULATION_MAX_AXIS_POINTS)
+    motivationLevels: Optional[List[float]] = Field(None, max_length=SIMULATION_MAX_AXIS_POINTS)
+    studentsPerCell: int = SIMULATION_STUDENTS
+    seed: int = 0
+    # Сохранить таблицу в SUCCESS_TABLE_PATH и использовать для successProbability во всех воркерах
+    activate: bool = False
+
+class CalibrationBin(BaseModel):
+    predicted: float
+    simulated: float
+    cells: int
+
+class StepFunctionComparison(BaseModel):
+    meanAbsoluteError: float
+    bias: float
+    maxAbsoluteError: float
+    calibration: List[CalibrationBin]
+
+class SimulationResponse(BaseModel):
+    success: bool
+    gridShape: Dict[str, int]
+    cells: int
+    trajectories: int
+    stepFunction: StepFunctionComparison
+    activated: bool
+    processingTime: float
+
 # Полная база знаний ЕГЭ математика с расширенными метаданными
 EGE_MATH_TOPICS = {
     'Базовые навыки': [
@@ -155,9 +442,1373 @@ EGE_MATH_TOPICS = {
     ]
 }
 
-class AdaptiveStudyPlanGenerator:
+# Темы, которые встречаются в нескольких категориях.
+# Для них явно задается основная категория, из которой берутся метаданные темы.
+CATALOG_PRIMARY_CATEGORIES = {
+    'Тригонометрические функции': 'Тригонометрия'
+}
+
+# Сложные темы, добавляемые ученикам с высоким целевым баллом
+ADVANCED_TARGET_TOPICS = {
+    'Задачи с параметрами': {'weight': 0.9, 'base_time': 18, 'complexity': 5, 'importance': 'high'},
+    'Исследование уравнений с параметрами': {'weight': 0.8, 'base_time': 15, 'complexity': 5, 'importance': 'high'},
+    'Сложные стереометрические задачи': {'weight': 0.8, 'base_time': 14, 'complexity': 5, 'importance': 'high'},
+    'Олимпиадные задачи': {'weight': 0.7, 'base_time': 12, 'complexity': 5, 'importance': 'medium'}
+}
+ADVANCED_TARGET_CATEGORY = 'Продвинутые темы'
+ADVANCED_TARGET_DEPENDENCIES = ('Квадратные уравнения', 'Неравенства', 'Функции')
+
+# Устаревшие названия в карте зависимостей и соответствующие им темы каталога
+TOPIC_DEPENDENCY_ALIASES = {
+    'Корни': 'Степени и корни',
+    'Основные тождества': 'Тригонометрические тождества',
+    'Интегралы': 'Определенный интеграл'
+}
+
+# Сетка симуляции по умолчанию: текущий балл, цель, часы в неделю, недели до экзамена, мотивация
+SIMULATION_GRID = {
+    'currentScore': (10, 20, 30, 40, 50, 60, 70, 80, 90),
+    'targetScore': (30, 40, 50, 60, 70, 80, 90, 100),
+    'hoursPerWeek': (2, 4, 6, 8, 10, 12, 15, 20, 30),
+    'weeks': (4, 8, 12, 16, 20, 26, 39, 52, 78, 104),
+    'motivation': (1, 3, 5, 7, 10)
+}
+
+# Модель траектории балла: недельный прирост - доля оставшегося до 100 запаса,
+# растет с часами (с убывающей отдачей) и мотивацией, умножается на личную эффективность
+SIMULATION_MODEL = {
+    'gain_rate': 0.003,          # доля запаса за неделю при одном часе и средней мотивации
+    'hours_exponent': 0.8,
+    'motivation_base': 0.7,
+    'motivation_slope': 0.06,
+    'efficiency_sigma': 0.35,    # логнормальный разброс эффективности учеников
+    'weekly_noise': 1.0,         # колебание балла за неделю
+    'exam_noise': 3.0            # разброс результата в день экзамена
+}
+
+# Ресурсы для тем по уровню плана: общие и по стилю обучения
+TOPIC_RESOURCES = {
+    'standard': {
+        'common': [
+            "Сборник ФИПИ 2024",
+            "Типовые экзаменационные варианты",
+            "EGE Trainer - онлайн тренажер"
+        ],
+        'visual': [
+            "Интерактивные видеуроки",
+            "Анимированные объяснения",
+            "Графические схемы и диаграммы"
+        ],
+        'auditory': [
+            "Аудиолекции по теме",
+            "Подкасты с разбором задач",
+            "Обсуждения в учебных группах"
+        ],
+        'kinesthetic': [
+            "Интерактивные симуляции",
+            "Практические эксперименты",
+            "Физические модели и макеты"
+        ],
+        'reading_writing': [
+            "Детальные конспекты",
+            "Письменные упражнения",
+            "Аналитические задания"
+        ]
+    },
+    'advanced': {
+        'common': [
+            "Сборник олимпиадных задач",
+            "Углубленный курс математики",
+            "Задачи с параметрами (продвинутый уровень)",
+            "Методы доказательств в математике"
+        ],
+        'visual': [
+            "Продвинутые визуализации",
+            "Интерактивные 3D-модели сложных концепций",
+            "Анимации доказательств"
+        ],
+        'auditory': [
+            "Лекции ведущих математиков",
+            "Обсуждения сложных задач",
+            "Подкасты о математических методах"
+        ],
+        'kinesthetic': [
+            "Сложные интерактивные симуляции",
+            "Практика доказательств на доске",
+            "Решение нестандартных задач"
+        ],
+        'reading_writing': [
+            "Научные статьи по теме",
+            "Ведение математического дневника",
+            "Анализ сложных решений"
+        ]
+    }
+}
+
+# Специфические ресурсы: добавляются темам, в названии которых встречается ключ
+TOPIC_SPECIFIC_RESOURCES = {
+    'standard': {
+        'Геометрия': ['3D-визуализатор', 'Геометрический конструктор'],
+        'Тригонометрия': ['Тригонометрический круг', 'Анимированные графики'],
+        'Производная': ['Графический анализатор', 'Интерактивные пределы'],
+        'Вероятность': ['Вероятностные симуляции', 'Статистические визуализации']
+    },
+    'advanced': {
+        'Параметры': [
+            'Методы исследования функций с параметрами',
+            'Графические методы решения параметрических задач'
+        ],
+        'Стереометрия': [
+            'Сложные пространственные конструкции',
+            'Методы координат в пространстве'
+        ],
+        'Производная': [
+            'Приложения производной в физике',
+            'Оптимизационные задачи повышенной сложности'
+        ]
+    }
+}
+
+# Синонимы слабых областей: название из анкеты -> темы или категории каталога
+WEAK_AREA_SYNONYMS = {
+    'Геометрия': ('Планиметрия', 'Стереометрия'),
+    'Алгебра': ('Базовые навыки', 'Уравнения', 'Неравенства'),
+    'Логарифмы': ('Логарифмические уравнения', 'Логарифмические неравенства', 'Логарифмические функции'),
+    'Интегралы': ('Первообразная',),
+    'Вероятность': ('Теория вероятностей',),
+    'Тервер': ('Теория вероятностей',),
+    'Корень': ('Степени и корни',),
+    'Графики': ('Графики функций',),
+    'Экономические задачи': ('Задачи на проценты',),
+    'Последовательности': ('Прогрессии',)
+}
+
+# Ключевые слова критичности пробела (сравниваются как целые слова)
+WEAK_AREA_SEVERITY_KEYWORDS = {
+    'critical': ('функции', 'уравнения', 'производная'),
+    'significant': ('геометрия', 'тригонометрия')
+}
+
+# Множители времени изучения по уровню сложности и стилю обучения
+LEVEL_TIME_MULTIPLIERS = {
+    DifficultyLevel.BEGINNER: 1.5,
+    DifficultyLevel.INTERMEDIATE: 1.2,
+    DifficultyLevel.ADVANCED: 0.9
+}
+
+STYLE_TIME_MULTIPLIERS = {
+    LearningStyle.VISUAL: 0.9,
+    LearningStyle.AUDITORY: 1.1,
+    LearningStyle.KINESTHETIC: 1.0,
+    LearningStyle.READING_WRITING: 1.0
+}
+
+@dataclass(frozen=True, slots=True)
+class TopicRecord:
+    """Неизменяемая запись каталога, общая для всех запросов"""
+    name: str
+    category: str
+    weight: float
+    base_time: int
+    complexity: int
+    importance: str
+    categories: Tuple[str, ...]
+
+@dataclass(slots=True)
+class TopicScore:
+    """Оценка темы в рамках одного запроса: ссылка на запись каталога и персональные значения"""
+    record: TopicRecord
+    priority: float
+    estimated_time: int
+    dependencies: Tuple[str, ...] = ()
+
+# Записи сложных тем для высоких целевых баллов строятся один раз
+ADVANCED_TARGET_RECORDS = MappingProxyType({
+    name: TopicRecord(name=name, category=ADVANCED_TARGET_CATEGORY, categories=(ADVANCED_TARGET_CATEGORY,), **info)
+    for name, info in ADVANCED_TARGET_TOPICS.items()
+})
+
+def complexity_bucket(complexity: int) -> str:
+    """Группа сложности темы для аналитики"""
+    if complexity <= 2:
+        return 'easy'
+    elif complexity <= 4:
+        return 'medium'
+    return 'hard'
+
+class CatalogIndex:
+    """Неизменяемый индекс базы знаний, строится один раз при старте"""
+
+    def __init__(self, catalog: Dict[str, List[Dict[str, Any]]], primary_categories: Dict[str, str]):
+        occurrences: Dict[str, List[str]] = {}
+        for category_name, category_topics in catalog.items():
+            for topic in category_topics:
+                occurrences.setdefault(topic['name'], []).append(category_name)
+        
+        # Разрешаем дубликаты: основная категория задается явно, иначе берется первое вхождение
+        primary: Dict[str, str] = {}
+        for name, categories in occurrences.items():
+            if len(categories) == 1:
+                primary[name] = categories[0]
+            elif name in primary_categories:
+                if primary_categories[name] not in categories:
+                    raise ValueError(f"Тема '{name}' отсутствует в категории '{primary_categories[name]}'")
+                primary[name] = primary_categories[name]
+            else:
+                primary[name] = categories[0]
+                logger.warning(f"⚠️ Тема '{name}' встречается в категориях {categories}, "
+                               f"используется '{categories[0]}'")
+        
+        topics: Dict[str, TopicRecord] = {}
+        category_names: Dict[str, Tuple[str, ...]] = {}
+        buckets: Dict[str, List[str]] = {'easy': [], 'medium': [], 'hard': []}
+        for category_name, category_topics in catalog.items():
+            category_names[category_name] = tuple(topic['name'] for topic in category_topics)
+            for topic in category_topics:
+                name = topic['name']
+                if primary[name] != category_name:
+                    continue
+                topics[name] = TopicRecord(
+                    name=name,
+                    category=category_name,
+                    weight=topic['weight'],
+                    base_time=topic['base_time'],
+                    complexity=topic['complexity'],
+                    importance=topic['importance'],
+                    categories=tuple(occurrences[name])
+                )
+                buckets[complexity_bucket(topic['complexity'])].append(name)
+        
+        self.topics: Mapping[str, TopicRecord] = MappingProxyType(topics)
+        self.categories: Mapping[str, Tuple[str, ...]] = MappingProxyType(category_names)
+        self.complexity_buckets: Mapping[str, FrozenSet[str]] = MappingProxyType(
+            {bucket: frozenset(names) for bucket, names in buckets.items()}
+        )
+        self.duplicates: Mapping[str, Tuple[str, ...]] = MappingProxyType(
+            {name: tuple(categories) for name, categories in occurrences.items() if len(categories) > 1}
+        )
+        self._bucket_by_name: Mapping[str, str] = MappingProxyType(
+            {name: bucket for bucket, names in buckets.items() for name in names}
+        )
+        
+        # Колоночное представление для векторных расчетов (порядок совпадает с self.topics)
+        self.names: Tuple[str, ...] = tuple(topics)
+        self.positions: Mapping[str, int] = MappingProxyType({name: i for i, name in enumerate(self.names)})
+        self.weight = self._frozen_column([topics[name].weight for name in self.names], np.float64)
+        self.base_time = self._frozen_column([topics[name].base_time for name in self.names], np.int64)
+        self.complexity_values = self._frozen_column([topics[name].complexity for name in self.names], np.int64)
+
+    @staticmethod
+    def _frozen_column(values: List[Any], dtype) -> np.ndarray:
+        column = np.array(values, dtype=dtype)
+        column.flags.writeable = False
+        return column
+
+    def mask(self, names) -> np.ndarray:
+        """Булева маска тем каталога, входящих в names (неизвестные имена игнорируются)"""
+        result = np.zeros(len(self.names), dtype=bool)
+        positions = [self.positions[name] for name in names if name in self.positions]
+        result[positions] = True
+        return result
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.topics
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.topics)
+
+    def __len__(self) -> int:
+        return len(self.topics)
+
+    def get(self, name: str) -> Optional[TopicRecord]:
+        return self.topics.get(name)
+
+    def complexity(self, name: str) -> Optional[int]:
+        topic = self.topics.get(name)
+        return topic.complexity if topic is not None else None
+
+    def difficulty_bucket(self, name: str) -> Optional[str]:
+        return self._bucket_by_name.get(name)
+
+CATALOG_INDEX = CatalogIndex(EGE_MATH_TOPICS, CATALOG_PRIMARY_CATEGORIES)
+
+class DependencyGraph:
+    """Скомпилированный граф зависимостей между темами (DAG), строится один раз при старте.
+
+    Названия категорий раскрываются в темы категории (с обеих сторон зависимости),
+    устаревшие названия разрешаются через алиасы, неизвестные отбрасываются с предупреждением.
+    """
+
+    def __init__(self, raw_dependencies: Mapping[str, Any], catalog: CatalogIndex,
+                 aliases: Optional[Mapping[str, str]] = None, extra_topics=()):
+        aliases = aliases or {}
+        nodes = list(catalog.names) + [name for name in extra_topics if name not in catalog]
+        node_set = set(nodes)
+        unresolved: List[str] = []
+
+        def resolve(name: str) -> Tuple[str, ...]:
+            name = aliases.get(name, name)
+            if name in node_set:
+                return (name,)
+            if name in catalog.categories:
+                return catalog.categories[name]
+            unresolved.append(name)
+            return ()
+
+        direct: Dict[str, set] = {name: set() for name in nodes}
+        for topic, deps in raw_dependencies.items():
+            targets = [dep for raw in deps for dep in resolve(raw)]
+            for name in resolve(topic):
+                direct[name].update(dep for dep in targets if dep != name)
+        for name in dict.fromkeys(unresolved):
+            logger.warning(f"⚠️ Зависимость '{name}' не найдена в каталоге и пропущена")
+
+        # Топологический порядок (алгоритм Кана, при равенстве - порядок каталога)
+        index = {name: i for i, name in enumerate(nodes)}
+        dependents: Dict[str, List[str]] = {name: [] for name in nodes}
+        in_degree = {name: len(deps) for name, deps in direct.items()}
+        for name, deps in direct.items():
+            for dep in deps:
+                dependents[dep].append(name)
+        heap = [(index[name], name) for name in nodes if in_degree[name] == 0]
+        heapq.heapify(heap)
+        order: List[str] = []
+        while heap:
+            _, name = heapq.heappop(heap)
+            order.append(name)
+            for dependent in dependents[name]:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    heapq.heappush(heap, (index[dependent], dependent))
+        if len(order) < len(nodes):
+            cycle = sorted((name for name in nodes if in_degree[name] > 0), key=index.get)
+            raise ValueError(f"Цикл в зависимостях тем: {cycle}")
+
+        rank = {name: i for i, name in enumerate(order)}
+        by_rank = rank.get
+        ancestors: Dict[str, FrozenSet[str]] = {}
+        for name in order:
+            closure = set(direct[name])
+            for dep in direct[name]:
+                closure |= ancestors[dep]
+            ancestors[name] = frozenset(closure)
+        descendants: Dict[str, set] = {name: set() for name in nodes}
+        for name, closure in ancestors.items():
+            for dep in closure:
+                descendants[dep].add(name)
+
+        self.order: Tuple[str, ...] = tuple(order)
+        self.rank: Mapping[str, int] = MappingProxyType(rank)
+        self.dependencies: Mapping[str, Tuple[str, ...]] = MappingProxyType(
+            {name: tuple(sorted(direct[name], key=by_rank)) for name in nodes}
+        )
+        self.dependents: Mapping[str, Tuple[str, ...]] = MappingProxyType(
+            {name: tuple(sorted(dependents[name], key=by_rank)) for name in nodes}
+        )
+        self.ancestors: Mapping[str, FrozenSet[str]] = MappingProxyType(ancestors)
+        self.descendants: Mapping[str, FrozenSet[str]] = MappingProxyType(
+            {name: frozenset(closure) for name, closure in descendants.items()}
+        )
+        self.unresolved: Tuple[str, ...] = tuple(dict.fromkeys(unresolved))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.rank
+
+    def requires(self, topic: str, prerequisite: str) -> bool:
+        """Зависит ли тема от prerequisite (прямо или транзитивно)"""
+        return prerequisite in self.ancestors.get(topic, ())
+
+    def pending_counts(self, names) -> Dict[str, int]:
+        """Число непройденных прямых зависимостей каждой темы внутри набора names.
+
+        Зависимости вне набора (исключенные или отсутствующие темы) считаются выполненными.
+        """
+        return {name: sum(1 for dep in self.dependencies.get(name, ()) if dep in names) for name in names}
+
+@dataclass(frozen=True, slots=True)
+class AreaMatch:
+    """Результат сопоставления слабой области: критичность пробела и темы каталога"""
+    severity: str
+    topics: Tuple[str, ...]
+
+class WeakAreaMatcher:
+    """Сопоставление слабых областей из анкеты с темами каталога, строится один раз при старте.
+
+    Сначала ищется точное совпадение нормализованной фразы с темой, категорией или синонимом,
+    иначе - темы, содержащие все основы слов области (индекс основа -> темы).
+    Критичность пробела - по целым словам-ключам в названии области.
+    Повторяющиеся у разных учеников названия берутся из ограниченного кэша.
+    """
+
+    STEM_LENGTH = 6
+    MIN_TOKEN_LENGTH = 3
+    SEVERITY_ORDER = ('critical', 'significant', 'minor')
+    _TOKEN_RE = re.compile(r'[0-9a-zа-я]+')
+
+    def __init__(self, catalog: CatalogIndex, synonyms: Optional[Mapping[str, Any]] = None,
+                 aliases: Optional[Mapping[str, str]] = None, extra_topics=(),
+                 severity_keywords: Optional[Mapping[str, Tuple[str, ...]]] = None,
+                 cache_size: int = WEAK_AREA_CACHE_SIZE):
+        names = list(catalog.names) + [name for name in extra_topics if name not in catalog]
+        order = {name: i for i, name in enumerate(names)}
+
+        def expand(name: str) -> Tuple[str, ...]:
+            if name in order:
+                return (name,)
+            return catalog.categories.get(name, ())
+
+        phrases: Dict[str, set] = {}
+        stems: Dict[str, set] = {}
+        entries = [(name, (name,)) for name in names]
+        entries += [(category, topics) for category, topics in catalog.categories.items()]
+        entries += [(alias, expand(target)) for alias, target in (aliases or {}).items()]
+        for label, targets in (synonyms or {}).items():
+            entries.append((label, tuple(topic for target in targets for topic in expand(target))))
+        for label, topics in entries:
+            phrases.setdefault(self._phrase(label), set()).update(topics)
+            # Синонимы и алиасы задают только точные фразы, основы слов берутся из каталога
+            if label in order or label in catalog.categories:
+                for stem in self._stems(label):
+                    stems.setdefault(stem, set()).update(topics)
+
+        sort_key = order.get
+        self.phrases: Mapping[str, Tuple[str, ...]] = MappingProxyType(
+            {phrase: tuple(sorted(topics, key=sort_key)) for phrase, topics in phrases.items()}
+        )
+        self.stems: Mapping[str, FrozenSet[str]] = MappingProxyType(
+            {stem: frozenset(topics) for stem, topics in stems.items()}
+        )
+        # Критичность определяется по целым словам: совпадение основ дает ложные срабатывания
+        # ("геометрическая" - не "геометрия", "произведение" - не "производная")
+        self.severity_keywords: Tuple[Tuple[FrozenSet[str], str], ...] = tuple(
+            (frozenset(self._tokens(keyword)), severity)
+            for severity, keywords in (severity_keywords or WEAK_AREA_SEVERITY_KEYWORDS).items()
+            for keyword in keywords
+        )
+        self._order = MappingProxyType(order)
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    @classmethod
+    def _tokens(cls, text: str) -> List[str]:
+        return cls._TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+
+    @classmethod
+    def _phrase(cls, text: str) -> str:
+        return ' '.join(cls._tokens(text))
+
+    @classmethod
+    def _stem(cls, token: str) -> str:
+        return token[:cls.STEM_LENGTH]
+
+    @classmethod
+    def _stems(cls, text: str) -> List[str]:
+        return [cls._stem(token) for token in cls._tokens(text) if len(token) >= cls.MIN_TOKEN_LENGTH]
+
+    def _match(self, area: str) -> AreaMatch:
+        """Критичность и темы каталога для одной слабой области (без кэша)"""
+        stems = self._stems(area)
+        tokens = set(self._tokens(area))
+        found = {severity for keyword, severity in self.severity_keywords if keyword <= tokens}
+        severity = next((level for level in self.SEVERITY_ORDER if level in found), 'minor')
+
+        topics = self.phrases.get(self._phrase(area))
+        if topics is None:
+            candidates: Optional[FrozenSet[str]] = None
+            for stem in stems:
+                posting = self.stems.get(stem, frozenset())
+                candidates = posting if candidates is None else candidates & posting
+                if not candidates:
+                    break
+            topics = tuple(sorted(candidates or (), key=self._order.get))
+        return AreaMatch(severity, topics)
+
+    def cache_info(self):
+        return self.match.cache_info()
+
+class ResourceTable:
+    """Неизменяемая таблица ресурсов, строится один раз при старте.
+
+    Каждому ресурсу присваивается короткий идентификатор; для всех сочетаний
+    (уровень, стиль обучения, тема) заранее собран кортеж идентификаторов.
+    Недельные планы ссылаются на идентификаторы, названия отдаются один раз в словаре плана.
+    """
+
+    def __init__(self, topics, base: Mapping[str, Mapping[str, List[str]]],
+                 specific: Mapping[str, Mapping[str, List[str]]]):
+        ids: Dict[str, str] = {}
+
+        def resource_id(title: str) -> str:
+            if title not in ids:
+                ids[title] = f"r{len(ids) + 1}"
+            return ids[title]
+
+        base_ids = {
+            (level, style): tuple(resource_id(title) for title in groups['common'] + groups[style.value])
+            for level, groups in base.items() for style in LearningStyle
+        }
+        specific_ids = {
+            level: tuple((key.lower(), tuple(resource_id(title) for title in titles)) for key, titles in keys.items())
+            for level, keys in specific.items()
+        }
+        self._base = MappingProxyType(base_ids)
+        self._specific = MappingProxyType(specific_ids)
+        self.by_topic: Mapping[Tuple[str, LearningStyle, str], Tuple[str, ...]] = MappingProxyType({
+            (level, style, topic): self._resolve(level, style, topic)
+            for level, style in base_ids for topic in topics
+        })
+        self.catalog: Mapping[str, str] = MappingProxyType({rid: title for title, rid in ids.items()})
+
+    def _resolve(self, level: str, style: LearningStyle, topic: str) -> Tuple[str, ...]:
+        resource_ids = self._base[level, style]
+        lowered = topic.lower()
+        for key, extra in self._specific[level]:
+            if key in lowered:
+                resource_ids += extra
+        return resource_ids
+
+    def ids(self, level: str, style: LearningStyle, topic: str) -> Tuple[str, ...]:
+        """Идентификаторы ресурсов темы; для тем вне таблицы считаются на лету"""
+        resource_ids = self.by_topic.get((level, style, topic))
+        return resource_ids if resource_ids is not None else self._resolve(level, style, topic)
+
+    def titles(self, resource_ids) -> List[str]:
+        return [self.catalog[rid] for rid in resource_ids]
+
+    def plan_catalog(self, level: str, style: LearningStyle, topics) -> Dict[str, str]:
+        """Словарь ресурсов плана: только идентификаторы, на которые ссылаются недели с topics"""
+        used = dict.fromkeys(rid for topic in topics for rid in self.ids(level, style, topic))
+        return {rid: self.catalog[rid] for rid in used}
+
+def score_topic_columns(weight: np.ndarray, base_time: np.ndarray, gap_boost: np.ndarray,
+                        preference: np.ndarray, current_score, target_score, motivation_level,
+                        level_multiplier, style_multiplier, max_time) -> Tuple[np.ndarray, np.ndarray]:
+    """Векторный расчет приоритета и времени изучения для колонок тем.
+
+    Повторяет calculate_adaptive_priority и estimate_learning_time_v2 поэлементно.
+    Параметры пользователя могут быть скалярами или массивами формы (U, 1)
+    при масках формы (U, T) - тогда за один вызов считается U учеников.
+    """
+    current_score = np.asarray(current_score, dtype=np.float64)
+    
+    level_factor = np.select(
+        [current_score < 40, current_score < 60, current_score < 80],
+        [np.where(base_time <= 5, 1.6, 0.6), np.where(base_time <= 7, 1.3, 0.8), 1.1],
+        np.where(base_time >= 8, 1.0, 0.9)
+    )
+    target_factor = 1.0 + (np.asarray(target_score, dtype=np.float64) - 50) / 100
+    motivation_factor = 0.8 + (np.asarray(motivation_level, dtype=np.float64) * 0.02)
+    priority = weight * gap_boost * level_factor * target_factor * motivation_factor * preference * 100
+    
+    target_multiplier = 1.0 + (np.asarray(target_score, dtype=np.float64) - 60) / 80
+    estimated_time = base_time * level_multiplier * target_multiplier * style_multiplier
+    estimated_time = np.maximum(2, np.minimum(np.rint(estimated_time), max_time)).astype(np.int64)
+    
+    return priority, estimated_time
+
+def utc_now() -> datetime:
+    """Текущее время с часовым поясом (UTC)"""
+    return datetime.now(timezone.utc)
+
+def parse_exam_date(exam_date: str) -> datetime:
+    """Дата экзамена с часовым поясом; дата без пояса считается датой в UTC"""
+    parsed = datetime.fromisoformat(exam_date.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def weeks_until_exam(days_until_exam: int) -> int:
+    """Горизонт подготовки в неделях (не меньше 4)"""
+    return max(4, days_until_exam // 7)
+
+def plan_cache_key(user_data: UserData, current_date: Optional[datetime] = None) -> str:
+    """Канонический ключ профиля: только поля, влияющие на generate_advanced_study_plan"""
+    days_until_exam = (parse_exam_date(user_data.examDate) - (current_date or utc_now())).days
+    
+    payload = {
+        'currentScore': user_data.currentScore,
+        'targetScore': user_data.targetScore,
+        'availableHoursPerWeek': user_data.availableHoursPerWeek,
+        # Порядок слабых областей влияет на приоритетные темы и ресурсы
+        'weakAreas': user_data.weakAreas,
+        'strongAreas': user_data.strongAreas,
+        'focusAreas': sorted(set(user_data.focusAreas or [])),
+        'learningStyle': user_data.learningStyle,
+        'preferredDifficulty': user_data.preferredDifficulty,
+        'motivationLevel': user_data.motivationLevel,
+        # Корзина горизонта: число недель и пороги дней для вероятности успеха
+        'totalWeeks': weeks_until_exam(days_until_exam),
+        'horizonBand': 2 if days_until_exam >= 90 else 1 if days_until_exam >= 60 else 0
+    }
+    # Перцентили прогресса меняют ответ; без них ключ остается прежним
+    if user_data.progressBands:
+        payload['progressBands'] = True
+    # Режим выбора тем входит в ключ, только если отличается от жадного по умолчанию
+    if user_data.selectionMode == SelectionMode.KNAPSACK:
+        payload['selectionMode'] = SelectionMode.KNAPSACK.value
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def progression_simulations(user_data: UserData) -> int:
+    """Число траекторий для перцентилей прогресса (0 - без перцентилей)"""
+    return PROGRESSION_SIMULATIONS if user_data.progressBands else 0
+
+def plan_seed(plan_key: str) -> int:
+    """Детерминированное зерно генератора случайных чисел из ключа плана"""
+    return int(plan_key[:16], 16)
+
+@dataclass(frozen=True, slots=True)
+class PlanContext:
+    """Неизменяемый контекст одного запроса: строится один раз и передается всем этапам генерации"""
+    user: UserData
+    now: datetime
+    exam_date: datetime
+    days_until_exam: int
+    total_weeks: int
+    total_hours: int
+    cache_key: str
+    learning_gaps: Mapping[str, Tuple[str, ...]]
+    area_topics: Mapping[str, Tuple[str, ...]]
+    critical_gaps: FrozenSet[str]
+    significant_gaps: FrozenSet[str]
+    weak_topics: FrozenSet[str]
+    strong_areas: FrozenSet[str]
+    focus_areas: FrozenSet[str]
+    level_multiplier: float
+    style_multiplier: float
+    max_topic_duration: int
+    learning_strategy: Mapping[str, Any]
+    difficulty_profile: Mapping[str, Any]
+
+    @property
+    def advanced(self) -> bool:
+        """Продвинутый ученик: сфокусированный план и фильтрация базовых тем"""
+        return self.user.currentScore > 70
+
+class PlanCache:
+    """LRU-кэш сгенерированных планов с ограничением времени жизни записей.
+
+    Планы хранятся сериализованными в JSON: байты в несколько раз компактнее дерева моделей.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.size_bytes -= len(value)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self.size_bytes -= len(previous[1])
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            self.size_bytes += len(value)
+            while len(self._entries) > self.maxsize:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key: Optional[str] = None) -> int:
+        """Удаляет одну запись или весь кэш; возвращает число удаленных записей"""
+        with self._lock:
+            if key is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                self.size_bytes = 0
+                return removed
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return 0
+            self.size_bytes -= len(entry[1])
+            return 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'bytes': self.size_bytes,
+                'ttlSeconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+def score_band(current_score: float) -> str:
+    """Диапазон текущего балла для меток метрик"""
+    if current_score < 40:
+        return 'low'
+    elif current_score < 60:
+        return 'basic'
+    elif current_score < 80:
+        return 'medium'
+    return 'high'
+
+def _format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                    for labels, value in self._values.items()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labelvalues: str, amount: float = 1.0):
+        self.inc(*labelvalues, amount=-amount)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждой комбинации меток: счетчики по корзинам (+Inf последняя) и сумма
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for labels, (counts, total) in self._series.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Минимальный реестр метрик в текстовом формате Prometheus"""
+
     def __init__(self):
-        self.topic_dependencies = self._build_advanced_dependencies()
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], List[_Metric]]] = []
+
+    def register(self, metric: _Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], List[_Metric]]):
+        """Коллектор вызывается при каждом опросе и возвращает актуальные метрики"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def max_topic_hours(complexity: int, advanced: bool) -> int:
+    """Предел часов на тему; для продвинутых учеников максимум на сложные темы увеличен"""
+    return 16 if advanced and complexity >= 4 else 12
+
+class TopicAllocator:
+    """Распределение часов подготовки между темами.
+
+    Темы выбираются из кучи по убыванию приоритета (при равенстве - в порядке анализа),
+    сумма приоритетов еще не распределенных кандидатов прохода ведется нарастающим итогом,
+    а готовность по зависимостям отслеживается счетчиками входящих зависимостей
+    по скомпилированному графу: проверка готовности - O(1).
+    """
+
+    PASSES = 3
+
+    def __init__(self, topic_analysis: Dict[str, TopicScore], total_hours: int,
+                 advanced: bool, critical_gaps: List[str], graph: DependencyGraph):
+        self.topic_analysis = topic_analysis
+        self.remaining_hours = total_hours
+        # Для продвинутых учеников: фокус на сложных темах и пробелах
+        self.advanced = advanced
+        self.critical_gaps = set(critical_gaps)
+        self.order = {name: i for i, name in enumerate(topic_analysis)}
+        self.schedule: Dict[str, Dict[str, Any]] = {}
+        self.graph = graph
+        
+        # Счетчики невыполненных зависимостей; зависимости вне анализа считаются выполненными
+        self.pending_deps: Dict[str, int] = {
+            name: sum(1 for dep in info.dependencies if dep in topic_analysis)
+            for name, info in topic_analysis.items()
+        }
+
+    def allocate(self) -> Dict[str, Dict[str, Any]]:
+        for pass_num in range(self.PASSES):
+            if self.remaining_hours <= 0:
+                break
+            if pass_num == 0:
+                self._run_pass(self._initial_candidates(), release=True)
+            else:
+                # Последующие проходы добирают оставшиеся темы без учета зависимостей
+                self._run_pass([name for name in self.topic_analysis if name not in self.schedule])
+        return self.schedule
+
+    def _first_pass_eligible(self, name: str) -> bool:
+        # Первый проход для продвинутых: только сложные темы и пробелы
+        return (not self.advanced
+                or self.topic_analysis[name].record.complexity >= 4
+                or name in self.critical_gaps)
+
+    def _initial_candidates(self) -> List[str]:
+        ready = [name for name in self.topic_analysis if self.is_ready(name)]
+        candidates = [name for name in ready if self._first_pass_eligible(name)]
+        if not candidates:
+            candidates = [name for name in ready if not self.topic_analysis[name].dependencies]
+        return candidates
+
+    def _run_pass(self, candidates: List[str], release: bool = False):
+        """Проход распределения; с release=True темы, ставшие готовыми, добавляются в текущий проход"""
+        candidates = list(candidates)
+        queued = set(candidates)
+        heap = [(-self.topic_analysis[name].priority, self.order[name], name) for name in candidates]
+        heapq.heapify(heap)
+        total_priority = sum(self.topic_analysis[name].priority for name in candidates)
+        ordered_candidates = None
+        
+        while heap and self.remaining_hours > 0:
+            _, _, topic_name = heapq.heappop(heap)
+            topic_info = self.topic_analysis[topic_name]
+            needed_time = topic_info.estimated_time
+            
+            if total_priority > 0:
+                share = self.remaining_hours * (topic_info.priority / total_priority)
+                # После вычитаний нарастающая сумма расходится с прямой суммой оставшихся
+                # приоритетов в последних битах, а int() чувствителен к этому только у целой
+                # границы. Пример (тест test_last_candidate_gets_whole_remainder): приоритеты
+                # 17.6, 24.0, 20.8 и 28 часов - последней теме положен весь остаток в 9 часов,
+                # но 17.6 + 24.0 + 20.8 - 24.0 - 20.8 = 17.600000000000005 дает долю 8.999...
+                # и 8 часов. Поэтому у границы (окно 1e-6 много шире такой погрешности) сумма
+                # считается напрямую в порядке кучи, как в прежнем квадратичном проходе, и
+                # расписания совпадают с ним. Точная арифметика (Fraction) не подходит: она
+                # меняет расписания там, где прежний расчет во float округлял вниз (~1% профилей).
+                if abs(share - round(share)) < 1e-6:
+                    if ordered_candidates is None:
+                        ordered_candidates = sorted(candidates, key=lambda n: (-self.topic_analysis[n].priority, self.order[n]))
+                    exact_total = sum(
+                        self.topic_analysis[name].priority for name in ordered_candidates
+                        if name not in self.schedule
+                    )
+                    share = self.remaining_hours * (topic_info.priority / exact_total)
+                allocated_time = min(needed_time, int(share))
+            else:
+                allocated_time = needed_time
+            
+            max_time = max_topic_hours(topic_info.record.complexity, self.advanced)
+            allocated_time = max(2, min(allocated_time, max_time))
+            
+            if allocated_time >= 2 and self.remaining_hours >= allocated_time:
+                self.schedule[topic_name] = {
+                    'allocated_hours': allocated_time,
+                    'priority': topic_info.priority,
+                    'category': topic_info.record.category,
+                    'week_distribution': [],
+                    'complexity': topic_info.record.complexity
+                }
+                self.remaining_hours -= allocated_time
+                total_priority -= topic_info.priority
+                for name in self._release(topic_name):
+                    if release and name not in queued and self._first_pass_eligible(name):
+                        queued.add(name)
+                        candidates.append(name)
+                        ordered_candidates = None
+                        total_priority += self.topic_analysis[name].priority
+                        heapq.heappush(heap, (-self.topic_analysis[name].priority, self.order[name], name))
+
+    def is_ready(self, topic_name: str) -> bool:
+        return self.pending_deps[topic_name] == 0
+
+    def _release(self, topic_name: str) -> List[str]:
+        """Снимает выполненную зависимость; возвращает темы, ставшие готовыми"""
+        ready = []
+        for dependent in self.graph.dependents.get(topic_name, ()):
+            if dependent in self.pending_deps and dependent not in self.schedule:
+                self.pending_deps[dependent] -= 1
+                if self.pending_deps[dependent] == 0:
+                    ready.append(dependent)
+        return ready
+
+class KnapsackAllocator:
+    """Распределение часов как рюкзак с выбором: динамика по бюджету часов на массивах NumPy.
+
+    Каждая тема - предмет с вариантами от 2 часов до своего предела (потребность темы,
+    не больше 12, для сложных тем у продвинутых - 16); ценность варианта - адаптивный
+    приоритет, умноженный на покрытую долю потребности. Шаг динамики по теме - одна
+    операция над окнами массива лучших значений, поэтому время - O(тем x бюджет x предел).
+
+    Замыкание по зависимостям: недостающие предшественники выбранных тем становятся
+    обязательными (не меньше 2 часов) и задача решается заново; если обязательные темы
+    не помещаются в бюджет, зависимые темы исключаются.
+    """
+
+    def __init__(self, topic_analysis: Dict[str, TopicScore], total_hours: int,
+                 advanced: bool, critical_gaps: List[str], graph: DependencyGraph):
+        self.topic_analysis = topic_analysis
+        self.total_hours = max(0, int(total_hours))
+        self.advanced = advanced
+        # Предшественники внутри анализа; зависимости вне анализа считаются выполненными
+        self.ancestors: Dict[str, FrozenSet[str]] = {
+            name: frozenset(dep for dep in graph.ancestors.get(name, ()) if dep in topic_analysis)
+            for name in topic_analysis
+        }
+
+    def _max_hours(self, topic_info: TopicScore) -> int:
+        # Те же границы, что и у жадного распределения
+        return max(2, min(topic_info.estimated_time, max_topic_hours(topic_info.record.complexity, self.advanced)))
+
+    def allocate(self) -> Dict[str, Dict[str, Any]]:
+        required: set = set()
+        excluded: set = set()
+        added: set = set()
+        triggers: set = set()
+        while True:
+            chosen = self._solve(required, excluded)
+            if chosen is None:
+                # Обязательные предшественники не помещаются: отказываемся от зависимых тем
+                required -= added
+                excluded |= triggers
+                required -= excluded
+                added, triggers = set(), set()
+                continue
+            missing: set = set()
+            triggers = set()
+            for name in chosen:
+                gap = self.ancestors[name] - chosen.keys()
+                if gap:
+                    missing |= gap
+                    triggers.add(name)
+            if not missing:
+                break
+            # Предшественник уже исключен - зависимая тема тоже не может войти в план
+            blocked = {name for name in triggers if self.ancestors[name] & excluded}
+            if blocked:
+                excluded |= blocked
+                required -= excluded
+                added, triggers = set(), set()
+                continue
+            added = missing
+            required |= missing
+
+        order = {name: i for i, name in enumerate(self.topic_analysis)}
+        ranked = sorted(chosen, key=lambda name: (-self.topic_analysis[name].priority, order[name]))
+        return {
+            name: {
+                'allocated_hours': chosen[name],
+                'priority': self.topic_analysis[name].priority,
+                'category': self.topic_analysis[name].record.category,
+                'week_distribution': [],
+                'complexity': self.topic_analysis[name].record.complexity
+            }
+            for name in ranked
+        }
+
+    def _solve(self, required: set, excluded: set) -> Optional[Dict[str, int]]:
+        """Оптимальные часы по темам; None, если обязательные темы не помещаются в бюджет"""
+        names = [name for name in self.topic_analysis if name not in excluded]
+        caps = np.array([self._max_hours(self.topic_analysis[name]) for name in names], dtype=np.int64)
+        # Бюджет сверх суммы пределов не меняет решения: все темы получают предел
+        budget = min(self.total_hours, int(caps.sum()))
+        if budget == int(caps.sum()):
+            return dict(zip(names, caps.tolist()))
+        
+        # Таблица ценностей всех тем сразу: строка - тема, столбец - часы
+        width = int(caps.max()) + 1
+        hours = np.arange(width)
+        priorities = np.array([self.topic_analysis[name].priority for name in names])
+        values = priorities[:, None] * hours / caps[:, None]
+        values[hours > caps[:, None]] = -np.inf
+        values[:, 1] = -np.inf  # меньше 2 часов на тему не выделяется
+        values[[name in required for name in names], 0] = -np.inf
+        
+        # best[b] - наибольшая ценность при затратах не больше b часов; слева - заглушки -inf.
+        # Сдвиги - представление над буфером: shifted[h, b] = best[b - h] после каждого шага,
+        # редукции идут вдоль длинной оси бюджета
+        padded = np.full(width - 1 + budget + 1, -np.inf)
+        best = padded[width - 1:]
+        best[:] = 0.0
+        shifted = np.lib.stride_tricks.sliding_window_view(padded, budget + 1)[::-1]
+        columns = values[:, :, None]
+        choices = np.empty((len(names), budget + 1), dtype=np.int16)
+        for i in range(len(names)):
+            candidates = shifted + columns[i]
+            choices[i] = candidates.argmax(axis=0)
+            best[:] = candidates.max(axis=0)
+        if best[budget] == -np.inf:
+            return None
+
+        chosen: Dict[str, int] = {}
+        remaining = budget
+        for i in range(len(names) - 1, -1, -1):
+            allocated = int(choices[i, remaining])
+            if allocated:
+                chosen[names[i]] = allocated
+                remaining -= allocated
+        return chosen
+
+@dataclass(frozen=True)
+class PackingStrategy:
+    """Правила упаковки тем в недели"""
+    min_chunk: int                      # минимум часов на тему за неделю
+    max_chunk: int                      # максимум часов на тему за неделю
+    max_chunk_complex: int              # максимум для сложных тем (complexity >= 4)
+    max_topics: Optional[int] = None    # ограничение числа тем в неделе
+
+    def chunk_limit(self, topic_info: Mapping[str, Any]) -> int:
+        if topic_info.get('complexity', 0) >= 4:
+            return self.max_chunk_complex
+        return self.max_chunk
+
+STANDARD_PACKING = PackingStrategy(min_chunk=2, max_chunk=8, max_chunk_complex=8)
+
+def focused_packing(current_score: float) -> PackingStrategy:
+    """Для продвинутых: меньше тем, но более глубокое изучение"""
+    return PackingStrategy(min_chunk=3, max_chunk=6, max_chunk_complex=10,
+                           max_topics=2 if current_score > 80 else 3)
+
+class WeeklyPacker:
+    """Упаковка распределенных часов по неделям.
+
+    Готовые темы лежат в куче по порядку расписания (порядку приоритета), зависимые темы
+    попадают в нее, когда последняя зависимость полностью распределена. Каждая тема
+    извлекается из кучи не больше одного раза за неделю, поэтому работа линейна
+    по числу недель. Входное расписание не изменяется.
+    """
+
+    def __init__(self, graph: DependencyGraph):
+        self.graph = graph
+
+    def pack(self, schedule: Mapping[str, Mapping[str, Any]], weekly_hours: int, total_weeks: int,
+             strategy: PackingStrategy) -> Iterator[List[Tuple[str, int, Mapping[str, Any]]]]:
+        """Отдает темы каждой недели списком (тема, часы, запись расписания)"""
+        order = {name: i for i, name in enumerate(schedule)}
+        remaining = {name: info['allocated_hours'] for name, info in schedule.items()}
+        pending_deps = self.graph.pending_counts(schedule)
+        ready = [(order[name], name) for name, count in pending_deps.items() if count == 0]
+        heapq.heapify(ready)
+        # Неделя меньше минимального куска не должна оставаться пустой
+        min_chunk = max(1, min(strategy.min_chunk, weekly_hours))
+        
+        week = 1
+        while remaining and week <= total_weeks:
+            week_topics = []
+            deferred = []
+            used = 0
+            while ready and weekly_hours - used >= min_chunk:
+                if strategy.max_topics is not None and len(week_topics) >= strategy.max_topics:
+                    break
+                _, topic_name = heapq.heappop(ready)
+                topic_info = schedule[topic_name]
+                topic_hours = remaining[topic_name]
+                hours = min(topic_hours, strategy.chunk_limit(topic_info), weekly_hours - used)
+                # Остаток темы меньше минимума забирается целиком, иначе тема никогда не влезет
+                if hours < min_chunk and hours < topic_hours:
+                    deferred.append(topic_name)
+                    continue
+                
+                week_topics.append((topic_name, hours, topic_info))
+                used += hours
+                if topic_hours > hours:
+                    remaining[topic_name] = topic_hours - hours
+                    deferred.append(topic_name)
+                else:
+                    del remaining[topic_name]
+                    for dependent in self.graph.dependents.get(topic_name, ()):
+                        if dependent in pending_deps:
+                            pending_deps[dependent] -= 1
+                            if pending_deps[dependent] == 0:
+                                heapq.heappush(ready, (order[dependent], dependent))
+            
+            for topic_name in deferred:
+                heapq.heappush(ready, (order[topic_name], topic_name))
+            yield week_topics
+            week += 1
+
+class SuccessProbabilityTable:
+    """Вероятность успеха на сетке (текущий балл, цель, часы, недели, мотивация).
+
+    Значения хранятся плотным массивом float32; запрос - мультилинейная интерполяция
+    по соседним узлам (не больше 32), значения вне сетки прижимаются к ее границам.
+    """
+
+    AXES = ('currentScore', 'targetScore', 'hoursPerWeek', 'weeks', 'motivation')
+
+    def __init__(self, axes: Mapping[str, Any], values: np.ndarray, meta: Optional[Dict[str, Any]] = None):
+        self.axes: Mapping[str, Tuple[float, ...]] = MappingProxyType(
+            {name: tuple(float(v) for v in axes[name]) for name in self.AXES}
+        )
+        for name, axis in self.axes.items():
+            if not axis or any(b <= a for a, b in zip(axis, axis[1:])):
+                raise ValueError(f"Ось '{name}' должна быть непустой и строго возрастающей")
+        shape = tuple(len(axis) for axis in self.axes.values())
+        if values.shape != shape:
+            raise ValueError(f"Форма таблицы {values.shape} не совпадает с осями {shape}")
+        self.values = np.ascontiguousarray(values, dtype=np.float32)
+        self.values.flags.writeable = False
+        self.meta = dict(meta or {})
+        self._flat: List[float] = self.values.ravel().tolist()
+        self._strides = tuple(stride // self.values.itemsize for stride in self.values.strides)
+
+    @classmethod
+    def load(cls, path: str) -> "SuccessProbabilityTable":
+        with np.load(path, allow_pickle=False) as data:
+            return cls({name: data[name] for name in cls.AXES}, data['values'], json.loads(str(data['meta'])))
+
+    def save(self, path: str):
+        """Запись через временный файл: воркеры не прочитают таблицу наполовину записанной"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(
+                f, values=self.values, meta=np.array(json.dumps(self.meta, ensure_ascii=False)),
+                **{name: np.array(axis) for name, axis in self.axes.items()}
+            )
+        os.replace(temp_path, path)
+
+    def probability(self, current_score: float, target_score: float, hours_per_week: float,
+                    weeks: float, motivation: float) -> float:
+        # По каждой оси - не больше двух соседних узлов с весами; узлы перемножаются в смещения плоского массива
+        corners = [(0, 1.0)]
+        point = (current_score, target_score, hours_per_week, weeks, motivation)
+        for axis, stride, value in zip(self.axes.values(), self._strides, point):
+            if value <= axis[0]:
+                terms = ((0, 1.0),)
+            elif value >= axis[-1]:
+                terms = (((len(axis) - 1) * stride, 1.0),)
+            else:
+                i = bisect.bisect_right(axis, value) - 1
+                t = (value - axis[i]) / (axis[i + 1] - axis[i])
+                terms = ((i * stride, 1.0 - t), ((i + 1) * stride, t)) if t > 0 else ((i * stride, 1.0),)
+            corners = [(offset + step, weight * w) for offset, weight in corners for step, w in terms]
+        flat = self._flat
+        return sum(flat[offset] * weight for offset, weight in corners)
+
+def step_success_probability(current_score: float, target_score: float,
+                             days_until_exam: int, motivation_level: float) -> float:
+    """Ступенчатая оценка вероятности успеха (используется без таблицы симуляции)"""
+    base_probability = 0.5
+    
+    # Фактор разницы баллов
+    score_gap = target_score - current_score
+    if score_gap <= 10:
+        base_probability += 0.3
+    elif score_gap <= 20:
+        base_probability += 0.2
+    elif score_gap <= 30:
+        base_probability += 0.1
+    
+    # Фактор времени
+    if days_until_exam >= 90:
+        base_probability += 0.2
+    elif days_until_exam >= 60:
+        base_probability += 0.1
+    
+    # Фактор мотивации
+    base_probability += (motivation_level - 5) * 0.03
+    
+    return min(0.95, max(0.3, base_probability))
+
+def step_success_probabilities(current_score, target_score, days_until_exam, motivation_level) -> np.ndarray:
+    """Ступенчатая оценка для массивов (с broadcasting); слагаемые в том же порядке, что и у скаляра"""
+    score_gap = np.asarray(target_score, dtype=np.float64) - current_score
+    days = np.asarray(days_until_exam)
+    probability = 0.5 + np.select([score_gap <= 10, score_gap <= 20, score_gap <= 30], [0.3, 0.2, 0.1], 0.0)
+    probability = probability + np.select([days >= 90, days >= 60], [0.2, 0.1], 0.0)
+    probability = probability + (np.asarray(motivation_level, dtype=np.float64) - 5) * 0.03
+    return np.clip(probability, 0.3, 0.95)
+
+def simulate_success_table(grid: Mapping[str, Any], students: int, seed: int = 0,
+                           model: Mapping[str, float] = SIMULATION_MODEL) -> SuccessProbabilityTable:
+    """Монте-Карло: students траекторий на каждое сочетание (балл, часы, мотивация).
+
+    Цель и горизонт не размножают симуляцию: балл каждой траектории снимается в недели
+    из оси weeks и сравнивается сразу со всеми целями. Сочетания обрабатываются пачками
+    не больше SIMULATION_BATCH_TRAJECTORIES траекторий, каждая неделя - одна операция над пачкой.
+    """
+    axes = {name: np.asarray(sorted(set(grid[name])), dtype=np.float64) for name in SuccessProbabilityTable.AXES}
+    if students < 1 or axes['weeks'][0] < 1:
+        raise ValueError("Нужен хотя бы один ученик на точку сетки и горизонт не меньше недели")
+    rng = np.random.default_rng(seed)
+    targets = axes['targetScore']
+    if not np.all(axes['weeks'] == np.round(axes['weeks'])):
+        raise ValueError("Недели в оси weeks должны быть целыми")
+    if axes['weeks'][-1] > SIMULATION_MAX_WEEKS:
+        raise ValueError(f"Горизонт {int(axes['weeks'][-1])} недель больше максимума {SIMULATION_MAX_WEEKS}")
+    checkpoints = {int(week): i for i, week in enumerate(axes['weeks'])}
+    
+    current, hours, motivation = (
+        column.ravel() for column in np.meshgrid(axes['currentScore'], axes['hoursPerWeek'], axes['motivation'],
+                                                 indexing='ij')
+    )
+    rate = (model['gain_rate'] * hours ** model['hours_exponent']
+            * (model['motivation_base'] + model['motivation_slope'] * motivation))
+    
+    # Результат по сочетаниям: (сочетание, цель, горизонт)
+    success = np.empty((current.size, targets.size, len(checkpoints)), dtype=np.float32)
+    batch = max(1, SIMULATION_BATCH_TRAJECTORIES // students)
+    for start in range(0, current.size, batch):
+        cells = slice(start, start + batch)
+        size = (len(current[cells]), students)
+        score = np.repeat(current[cells, None], students, axis=1)
+        cell_rate = rate[cells, None] * rng.lognormal(0.0, model['efficiency_sigma'], size=size)
+        for week in range(1, int(axes['weeks'][-1]) + 1):
+            score += cell_rate * (100.0 - score) + rng.normal(0.0, model['weekly_noise'], size=size)
+            np.clip(score, 0.0, 100.0, out=score)
+            if week in checkpoints:
+                exam = score + rng.normal(0.0, model['exam_noise'], size=size)
+                success[cells, :, checkpoints[week]] = (exam[:, :, None] >= targets).mean(axis=1)
+    
+    # (балл, часы, мотивация, цель, недели) -> порядок осей таблицы
+    shape = (axes['currentScore'].size, axes['hoursPerWeek'].size, axes['motivation'].size,
+             targets.size, axes['weeks'].size)
+    values = success.reshape(shape).transpose(0, 3, 1, 4, 2)
+    meta = {'students': students, 'seed': seed, 'model': dict(model), 'createdAt': utc_now().isoformat()}
+    return SuccessProbabilityTable(axes, values, meta)
+
+def compare_with_step_function(table: SuccessProbabilityTable) -> Dict[str, Any]:
+    """Сравнение ступенчатой оценки с симуляцией во всех узлах сетки"""
+    simulated = table.values.astype(np.float64)
+    # Ступенчатая оценка не зависит от часов: считается по остальным осям и растягивается по часам
+    current, target, _, weeks, motivation = np.ix_(*table.axes.values())
+    step = step_success_probabilities(current, target, weeks.astype(np.int64) * 7, motivation)
+    # Округление убирает погрешность сложения долей, чтобы одинаковые оценки попали в одну группу
+    step = np.broadcast_to(step, simulated.shape).round(4)
+    error = step - simulated
+    
+    # Калибровка: для каждого значения ступенчатой оценки - средняя вероятность по симуляции
+    levels, groups = np.unique(step, return_inverse=True)
+    counts = np.bincount(groups.ravel(), minlength=levels.size)
+    sums = np.bincount(groups.ravel(), weights=simulated.ravel(), minlength=levels.size)
+    calibration = [
+        {'predicted': float(predicted), 'simulated': round(float(total / count), 4), 'cells': int(count)}
+        for predicted, total, count in zip(levels, sums, counts)
+    ]
+    return {
+        'meanAbsoluteError': float(np.abs(error).mean()),
+        'bias': float(error.mean()),
+        'maxAbsoluteError': float(np.abs(error).max()),
+        'calibration': calibration
+    }
+
+def load_success_table(path: str) -> Optional[SuccessProbabilityTable]:
+    """Загружает таблицу симуляции, если путь задан; ошибки не мешают запуску сервиса"""
+    if not path:
+        return None
+    try:
+        table = SuccessProbabilityTable.load(path)
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning(f"⚠️ Таблица вероятности успеха {path} не загружена: {e}")
+        return None
+    logger.info(f"🎲 Загружена таблица вероятности успеха {path}: {table.values.size} узлов")
+    return table
+
+def run_success_simulation(grid: Mapping[str, Any], students: int,
+                           seed: int = 0) -> Tuple[SuccessProbabilityTable, Dict[str, Any]]:
+    """Симуляция таблицы и ее сравнение со ступенчатой оценкой (для /simulate и CLI)"""
+    start_time = time.perf_counter()
+    table = simulate_success_table(grid, students, seed)
+    comparison = compare_with_step_function(table)
+    logger.info(f"🎲 Симуляция: {table.values.size} узлов, {students} учеников на точку, "
+                f"{time.perf_counter() - start_time:.2f}с; MAE ступенчатой оценки "
+                f"{comparison['meanAbsoluteError']:.3f}")
+    return table, comparison
+
+success_table = load_success_table(SUCCESS_TABLE_PATH)
+
+class AdaptiveStudyPlanGenerator:
+    def __init__(self, catalog: Optional[CatalogIndex] = None):
+        self.catalog = catalog or CATALOG_INDEX
+        raw_dependencies = self._build_advanced_dependencies()
+        # Общие зависимости сложных тем - только для тем вне каталога: у одноименных тем каталога свои
+        raw_dependencies.update({
+            name: ADVANCED_TARGET_DEPENDENCIES for name in ADVANCED_TARGET_RECORDS if name not in self.catalog
+        })
+        self.dependency_graph = DependencyGraph(
+            raw_dependencies, self.catalog, TOPIC_DEPENDENCY_ALIASES, extra_topics=ADVANCED_TARGET_RECORDS
+        )
+        self.topic_dependencies = self.dependency_graph.dependencies
+        self.weekly_packer = WeeklyPacker(self.dependency_graph)
+        self.resource_table = ResourceTable(
+            list(self.catalog.names) + list(ADVANCED_TARGET_RECORDS), TOPIC_RESOURCES, TOPIC_SPECIFIC_RESOURCES
+        )
+        self.area_matcher = WeakAreaMatcher(
+            self.catalog, WEAK_AREA_SYNONYMS, TOPIC_DEPENDENCY_ALIASES, extra_topics=ADVANCED_TARGET_RECORDS
+        )
         self.learning_strategies = self._build_learning_strategies()
         self.difficulty_profiles = self._build_difficulty_profiles()
         self.basic_topics_for_advanced = self._define_basic_topics_to_exclude()
@@ -258,93 +1909,139 @@ class AdaptiveStudyPlanGenerator:
             'minor': []
         }
         
-        # Анализ слабых областей
+        # Анализ слабых областей: критичность определяется по целым словам названия
         for area in user_data.weakAreas:
-            # Определяем критичность пробела
-            if any(keyword in area.lower() for keyword in ['функции', 'уравнения', 'производная']):
-                gaps['critical'].append(area)
-            elif any(keyword in area.lower() for keyword in ['геометрия', 'тригонометрия']):
-                gaps['significant'].append(area)
-            else:
-                gaps['minor'].append(area)
+            gaps[self.area_matcher.match(area).severity].append(area)
         
         return gaps
 
-    def calculate_adaptive_priority(self, topic: Dict, user_data: UserData, learning_gaps: Dict) -> float:
+    def build_context(self, user_data: UserData, now: Optional[datetime] = None) -> PlanContext:
+        """Контекст запроса: даты, горизонт, пробелы и множители считаются один раз"""
+        now = now or utc_now()
+        exam_date = parse_exam_date(user_data.examDate)
+        days_until_exam = (exam_date - now).days
+        total_weeks = weeks_until_exam(days_until_exam)
+        gaps = self.analyze_learning_gaps(user_data)
+        area_topics = {area: self.area_matcher.match(area).topics for area in user_data.weakAreas}
+        
+        def gap_topics(level: str) -> FrozenSet[str]:
+            return frozenset(topic for area in gaps[level] for topic in area_topics[area])
+        
+        difficulty_profile = self.difficulty_profiles[user_data.preferredDifficulty]
+        return PlanContext(
+            user=user_data,
+            now=now,
+            exam_date=exam_date,
+            days_until_exam=days_until_exam,
+            total_weeks=total_weeks,
+            total_hours=total_weeks * user_data.availableHoursPerWeek,
+            cache_key=plan_cache_key(user_data, now),
+            learning_gaps=MappingProxyType({level: tuple(areas) for level, areas in gaps.items()}),
+            area_topics=MappingProxyType(area_topics),
+            critical_gaps=gap_topics('critical'),
+            significant_gaps=gap_topics('significant'),
+            weak_topics=frozenset(topic for topics in area_topics.values() for topic in topics),
+            strong_areas=frozenset(user_data.strongAreas),
+            focus_areas=frozenset(user_data.focusAreas or ()),
+            level_multiplier=LEVEL_TIME_MULTIPLIERS.get(user_data.preferredDifficulty, 1.2),
+            style_multiplier=STYLE_TIME_MULTIPLIERS.get(user_data.learningStyle, 1.0),
+            max_topic_duration=difficulty_profile['max_topic_duration'],
+            learning_strategy=MappingProxyType(self.learning_strategies[user_data.learningStyle]),
+            difficulty_profile=MappingProxyType(difficulty_profile)
+        )
+
+    def calculate_adaptive_priority(self, topic: TopicRecord, ctx: PlanContext) -> float:
         """Адаптивный расчет приоритета темы с учетом множества факторов"""
-        base_weight = topic['weight']
+        base_weight = topic.weight
         
         # Фактор слабых областей
-        if topic['name'] in learning_gaps['critical']:
+        if topic.name in ctx.critical_gaps:
             gap_boost = 3.0
-        elif topic['name'] in learning_gaps['significant']:
+        elif topic.name in ctx.significant_gaps:
             gap_boost = 2.0
-        elif topic['name'] in user_data.weakAreas:
+        elif topic.name in ctx.weak_topics:
             gap_boost = 1.5
         else:
             gap_boost = 1.0
         
         # Фактор текущего уровня
-        current_score = user_data.currentScore
+        current_score = ctx.user.currentScore
         if current_score < 40:
-            level_factor = 1.6 if topic['base_time'] <= 5 else 0.6
+            level_factor = 1.6 if topic.base_time <= 5 else 0.6
         elif current_score < 60:
-            level_factor = 1.3 if topic['base_time'] <= 7 else 0.8
+            level_factor = 1.3 if topic.base_time <= 7 else 0.8
         elif current_score < 80:
             level_factor = 1.1
         else:
-            level_factor = 1.0 if topic['base_time'] >= 8 else 0.9
+            level_factor = 1.0 if topic.base_time >= 8 else 0.9
         
         # Фактор целевого балла
-        target_factor = 1.0 + (user_data.targetScore - 50) / 100
+        target_factor = 1.0 + (ctx.user.targetScore - 50) / 100
         
         # Фактор мотивации
-        motivation_factor = 0.8 + (user_data.motivationLevel * 0.02)
+        motivation_factor = 0.8 + (ctx.user.motivationLevel * 0.02)
         
         # Фактор предпочтений пользователя
-        preference_factor = 1.2 if topic['name'] in user_data.focusAreas else 1.0
+        preference_factor = 1.2 if topic.name in ctx.focus_areas else 1.0
         
         return base_weight * gap_boost * level_factor * target_factor * motivation_factor * preference_factor * 100
 
-    def estimate_learning_time_v2(self, topic: Dict, user_data: UserData) -> int:
+    def estimate_learning_time_v2(self, topic: TopicRecord, ctx: PlanContext) -> int:
         """Улучшенная оценка времени изучения с учетом стиля обучения"""
-        base_time = topic['base_time']
-        
-        # Корректировка на основе текущего уровня
-        level_multipliers = {
-            DifficultyLevel.BEGINNER: 1.5,
-            DifficultyLevel.INTERMEDIATE: 1.2,
-            DifficultyLevel.ADVANCED: 0.9
-        }
-        level_multiplier = level_multipliers.get(user_data.preferredDifficulty, 1.2)
+        base_time = topic.base_time
         
         # Корректировка на целевой балл
-        target_multiplier = 1.0 + (user_data.targetScore - 60) / 80
-        
-        # Корректировка на стиль обучения
-        style_multipliers = {
-            LearningStyle.VISUAL: 0.9,
-            LearningStyle.AUDITORY: 1.1,
-            LearningStyle.KINESTHETIC: 1.0,
-            LearningStyle.READING_WRITING: 1.0
-        }
-        style_multiplier = style_multipliers.get(user_data.learningStyle, 1.0)
+        target_multiplier = 1.0 + (ctx.user.targetScore - 60) / 80
         
-        estimated_time = base_time * level_multiplier * target_multiplier * style_multiplier
+        # Корректировка на уровень и стиль обучения
+        estimated_time = base_time * ctx.level_multiplier * target_multiplier * ctx.style_multiplier
         
         # Ограничения по времени
-        max_time = self.difficulty_profiles[user_data.preferredDifficulty]['max_topic_duration']
-        return max(2, min(int(round(estimated_time)), max_time))
+        return max(2, min(int(round(estimated_time)), ctx.max_topic_duration))
+
+    def catalog_boosts(self, ctx: PlanContext) -> Tuple[np.ndarray, np.ndarray]:
+        """Колонки усиления пробелов и предпочтений по каталогу (не зависят от цели и часов)"""
+        catalog = self.catalog
+        
+        # Маски пробелов применяются по возрастанию силы, чтобы сохранить старшинство условий
+        gap_boost = np.ones(len(catalog))
+        gap_boost[catalog.mask(ctx.weak_topics)] = 1.5
+        gap_boost[catalog.mask(ctx.significant_gaps)] = 2.0
+        gap_boost[catalog.mask(ctx.critical_gaps)] = 3.0
+        preference = np.where(catalog.mask(ctx.focus_areas), 1.2, 1.0)
+        return gap_boost, preference
+
+    def score_catalog(self, ctx: PlanContext, target_score=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Приоритеты и время изучения для всех тем каталога за один векторный проход.
+
+        target_score формы (K, 1) дает матрицы (K, число тем) для K целевых баллов сразу.
+        """
+        catalog = self.catalog
+        gap_boost, preference = self.catalog_boosts(ctx)
+        
+        return score_topic_columns(
+            catalog.weight, catalog.base_time, gap_boost, preference,
+            current_score=ctx.user.currentScore,
+            target_score=ctx.user.targetScore if target_score is None else target_score,
+            motivation_level=ctx.user.motivationLevel,
+            level_multiplier=ctx.level_multiplier,
+            style_multiplier=ctx.style_multiplier,
+            max_time=ctx.max_topic_duration
+        )
 
-    def filter_topics_for_advanced_students(self, user_data: UserData, topics_analysis: Dict) -> Dict:
-        """Фильтрует темы для продвинутых учеников (currentScore > 70)"""
-        if user_data.currentScore < 70:
+    def filter_topics_for_advanced_students(self, ctx: PlanContext,
+                                            topics_analysis: Dict[str, TopicScore]) -> Dict[str, TopicScore]:
+        """Фильтрует темы для продвинутых учеников (currentScore > 70).
+
+        Анализ принадлежит текущему запросу, поэтому изменяется на месте, без копирования.
+        """
+        if ctx.user.currentScore < 70:
             return topics_analysis
             
-        filtered_analysis = topics_analysis.copy()
+        filtered_analysis = topics_analysis
         
         # Определяем стратегию фильтрации в зависимости от баллов
-        if user_data.currentScore >= 80:
+        if ctx.user.currentScore >= 80:
             strategy = 'high_score'
         else:
             strategy = 'medium_score'
@@ -359,244 +2056,167 @@ class AdaptiveStudyPlanGenerator:
         for topic_name in self.basic_topics_for_advanced[strategy]['reduce_time']:
             if topic_name in filtered_analysis:
                 # Уменьшаем время на 50-70%
-                original_time = filtered_analysis[topic_name]['estimated_time']
+                original_time = filtered_analysis[topic_name].estimated_time
                 reduced_time = max(2, int(original_time * 0.3))  # Оставляем 30% времени
-                filtered_analysis[topic_name]['estimated_time'] = reduced_time
+                filtered_analysis[topic_name].estimated_time = reduced_time
                 logger.info(f"⏱️ Уменьшено время на тему {topic_name}: {original_time}ч → {reduced_time}ч")
         
         return filtered_analysis
-
-    def adjust_for_high_target_score(self, user_data: UserData, topics_analysis: Dict) -> Dict:
-        """Добавляет сложные темы для учеников с высокими целевыми баллами"""
-        if user_data.targetScore < 85:
-            return topics_analysis
-            
-        adjusted_analysis = topics_analysis.copy()
-        
-        # Сложные темы для высоких баллов
-        advanced_topics = {
-            'Задачи с параметрами': {
-                'weight': 0.9,
-                'base_time': 18,
-                'complexity': 5,
-                'importance': 'high'
-            },
-            'Исследование уравнений с параметрами': {
-                'weight': 0.8,
-                'base_time': 15,
-                'complexity': 5,
-                'importance': 'high'
-            },
-            'Сложные стереометрические задачи': {
-                'weight': 0.8,
-                'base_time': 14,
-                'complexity': 5,
-                'importance': 'high'
-            },
-            'Олимпиадные задачи': {
-                'weight': 0.7,
-                'base_time': 12,
-                'complexity': 5,
-                'importance': 'medium'
-            }
-        }
+
+    def adjust_for_high_target_score(self, ctx: PlanContext,
+                                     topics_analysis: Dict[str, TopicScore]) -> Dict[str, TopicScore]:
+        """Добавляет сложные темы для учеников с высокими целевыми баллами (анализ изменяется на месте)"""
+        if ctx.user.targetScore < 85:
+            return topics_analysis
+            
+        adjusted_analysis = topics_analysis
         
         # Добавляем сложные темы если их еще нет
-        for topic_name, topic_info in advanced_topics.items():
+        for topic_name, record in ADVANCED_TARGET_RECORDS.items():
             if topic_name not in adjusted_analysis:
-                priority = self.calculate_adaptive_priority(
-                    topic_info, user_data, self.analyze_learning_gaps(user_data)
-                )
-                estimated_time = self.estimate_learning_time_v2(topic_info, user_data)
+                priority = self.calculate_adaptive_priority(record, ctx)
+                estimated_time = self.estimate_learning_time_v2(record, ctx)
                 
-                adjusted_analysis[topic_name] = {
-                    'priority': priority,
-                    'estimated_time': estimated_time,
-                    'category': 'Продвинутые темы',
-                    'base_time': topic_info['base_time'],
-                    'weight': topic_info['weight'],
-                    'complexity': topic_info['complexity'],
-                    'dependencies': ['Квадратные уравнения', 'Неравенства', 'Функции']
-                }
+                adjusted_analysis[topic_name] = TopicScore(
+                    record=record,
+                    priority=priority,
+                    estimated_time=estimated_time,
+                    dependencies=self.topic_dependencies[topic_name]
+                )
                 logger.info(f"🎯 Добавлена сложная тема для высокого балла: {topic_name}")
         
         return adjusted_analysis
 
-    def optimize_topic_selection(self, user_data: UserData) -> Dict[str, Dict[str, Any]]:
+    def optimize_topic_selection(self, ctx: PlanContext) -> Dict[str, Dict[str, Any]]:
         """Оптимизированный выбор тем с учетом уровня ученика"""
-        exam_date = datetime.fromisoformat(user_data.examDate.replace('Z', '+00:00'))
-        current_date = datetime.now()
-        total_weeks = max(4, (exam_date - current_date).days // 7)
-        total_hours = total_weeks * user_data.availableHoursPerWeek
-        
-        learning_gaps = self.analyze_learning_gaps(user_data)
-        
+        priorities, estimated_times = self.score_catalog(ctx)
+        topic_analysis = self.build_topic_analysis(ctx, priorities, estimated_times)
+        return self.allocate_hours(ctx, topic_analysis)
+
+    def build_topic_analysis(self, ctx: PlanContext, priorities: np.ndarray,
+                             estimated_times: np.ndarray) -> Dict[str, TopicScore]:
+        """Анализ тем запроса по оценкам каталога: фильтрация для продвинутых и сложные темы для высоких целей"""
         # Собираем все темы с расширенной информацией
-        topic_analysis = {}
-        for category_name, category_topics in EGE_MATH_TOPICS.items():
-            for topic in category_topics:
-                priority = self.calculate_adaptive_priority(topic, user_data, learning_gaps)
-                estimated_time = self.estimate_learning_time_v2(topic, user_data)
-                
-                topic_analysis[topic['name']] = {
-                    'priority': priority,
-                    'estimated_time': estimated_time,
-                    'category': category_name,
-                    'base_time': topic['base_time'],
-                    'weight': topic['weight'],
-                    'complexity': topic['complexity'],
-                    'dependencies': self.topic_dependencies.get(topic['name'], [])
-                }
+        dependencies = self.topic_dependencies
+        topic_analysis = {
+            record.name: TopicScore(record, priority, estimated_time, dependencies.get(record.name, ()))
+            for record, priority, estimated_time in zip(
+                self.catalog.topics.values(), priorities.tolist(), estimated_times.tolist()
+            )
+        }
         
         # Оптимизация для продвинутых учеников
-        if user_data.currentScore > 70:
-            topic_analysis = self.filter_topics_for_advanced_students(user_data, topic_analysis)
+        if ctx.advanced:
+            topic_analysis = self.filter_topics_for_advanced_students(ctx, topic_analysis)
         
         # Добавление сложных тем для высоких целевых баллов
-        if user_data.targetScore > 80:
-            topic_analysis = self.adjust_for_high_target_score(user_data, topic_analysis)
-        
-        # Оптимизированное распределение с учетом зависимостей
-        schedule = {}
-        remaining_hours = total_hours
-        scheduled_topics = set()
-        
-        def is_topic_ready(topic_name):
-            deps = topic_analysis[topic_name]['dependencies']
-            return all(dep in scheduled_topics for dep in deps)
-        
-        # Стратегия распределения в зависимости от уровня
-        if user_data.currentScore > 70:
-            # Для продвинутых: фокус на сложных темах и пробелах
-            distribution_strategy = 'advanced'
+        if ctx.user.targetScore > 80:
+            topic_analysis = self.adjust_for_high_target_score(ctx, topic_analysis)
+        return topic_analysis
+
+    def allocate_hours(self, ctx: PlanContext, topic_analysis: Dict[str, TopicScore]) -> Dict[str, Dict[str, Any]]:
+        """Распределение часов с учетом зависимостей (анализ тем не изменяется)"""
+        if ctx.user.selectionMode == SelectionMode.KNAPSACK:
+            allocator_class = KnapsackAllocator
         else:
-            # Для начинающих и средних: сбалансированный подход
-            distribution_strategy = 'balanced'
+            allocator_class = TopicAllocator
+        allocator = allocator_class(
+            topic_analysis,
+            ctx.total_hours,
+            advanced=ctx.advanced,
+            critical_gaps=ctx.critical_gaps,
+            graph=self.dependency_graph
+        )
+        return allocator.allocate()
+
+    def sweep(self, user_data: UserData, hours_options: List[int],
+              target_options: List[float]) -> Dict[str, Any]:
+        """Сравнение вариантов "что если" по сетке часов в неделю и целевых баллов.
+
+        Контекст, пробелы и колонки каталога считаются один раз, оценки тем - одним векторным
+        вызовом для всех целей; на каждый вариант выполняются только распределение часов и упаковка.
+        Матрицы результата: строки - часы, столбцы - цели. successProbability - None без таблицы
+        симуляции: ступенчатая оценка не учитывает часы и не различает варианты по бюджету.
+        """
+        ctx = self.build_context(user_data)
+        priorities, estimated_times = self.score_catalog(
+            ctx, np.asarray(target_options, dtype=np.float64)[:, None]
+        )
+        strategy = focused_packing(ctx.user.currentScore) if ctx.advanced else STANDARD_PACKING
+        shape = (len(hours_options), len(target_options))
+        topics_covered = np.zeros(shape, dtype=np.int64)
+        study_hours = np.zeros(shape, dtype=np.int64)
+        success_probability = np.zeros(shape) if success_table is not None else None
+        
+        for j, target_score in enumerate(target_options):
+            # Ключ кэша в вариантах не пересчитывается: он нужен только для зерна прогрессии
+            target_ctx = replace(ctx, user=ctx.user.model_copy(update={'targetScore': target_score}))
+            topic_analysis = self.build_topic_analysis(target_ctx, priorities[j], estimated_times[j])
+            for i, weekly_hours in enumerate(hours_options):
+                variant = replace(
+                    target_ctx,
+                    user=target_ctx.user.model_copy(update={'availableHoursPerWeek': weekly_hours}),
+                    total_hours=ctx.total_weeks * weekly_hours
+                )
+                schedule = self.allocate_hours(variant, topic_analysis)
+                packed = set()
+                for week_topics in self.weekly_packer.pack(schedule, weekly_hours, ctx.total_weeks, strategy):
+                    for topic_name, hours, _ in week_topics:
+                        packed.add(topic_name)
+                        study_hours[i, j] += hours
+                topics_covered[i, j] = len(packed)
+                if success_probability is not None:
+                    success_probability[i, j] = self._calculate_success_probability(variant)
         
-        for pass_num in range(3):
-            if remaining_hours <= 0:
-                break
-                
-            # Для продвинутых учеников меняем приоритеты на первых проходах
-            if distribution_strategy == 'advanced' and pass_num == 0:
-                # Первый проход: только сложные темы и пробелы
-                ready_topics = [
-                    (name, info) for name, info in topic_analysis.items()
-                    if name not in scheduled_topics and is_topic_ready(name)
-                    and (info['complexity'] >= 4 or name in learning_gaps['critical'])
-                ]
-            else:
-                # Стандартный отбор
-                ready_topics = [
-                    (name, info) for name, info in topic_analysis.items()
-                    if name not in scheduled_topics and (pass_num > 0 or is_topic_ready(name))
-                ]
-            
-            if not ready_topics and pass_num == 0:
-                ready_topics = [
-                    (name, info) for name, info in topic_analysis.items()
-                    if name not in scheduled_topics and not info['dependencies']
-                ]
-            
-            sorted_topics = sorted(ready_topics, key=lambda x: x[1]['priority'], reverse=True)
-            
-            for topic_name, topic_info in sorted_topics:
-                if remaining_hours <= 0:
-                    break
-                    
-                needed_time = topic_info['estimated_time']
-                
-                total_priority = sum(info['priority'] for _, info in sorted_topics if _ not in schedule)
-                if total_priority > 0:
-                    allocated_time = min(
-                        needed_time,
-                        int(remaining_hours * (topic_info['priority'] / total_priority))
-                    )
-                else:
-                    allocated_time = needed_time
-                
-                # Для продвинутых учеников увеличиваем максимум времени на сложные темы
-                if (distribution_strategy == 'advanced' and 
-                    topic_info.get('complexity', 0) >= 4):
-                    max_time = 16
-                else:
-                    max_time = 12
-                
-                allocated_time = max(2, min(allocated_time, max_time))
-                
-                if allocated_time >= 2 and remaining_hours >= allocated_time:
-                    schedule[topic_name] = {
-                        'allocated_hours': allocated_time,
-                        'priority': topic_info['priority'],
-                        'category': topic_info['category'],
-                        'week_distribution': [],
-                        'complexity': topic_info.get('complexity', 3)
-                    }
-                    scheduled_topics.add(topic_name)
-                    remaining_hours -= allocated_time
-        
-        return schedule
-
-    def generate_optimized_schedule(self, user_data: UserData) -> Dict[str, Dict[str, Any]]:
+        return {
+            'durationWeeks': ctx.total_weeks,
+            'hoursPerWeek': list(hours_options),
+            'targetScores': list(target_options),
+            'topicsCovered': topics_covered.tolist(),
+            'studyHours': study_hours.tolist(),
+            'successProbability': success_probability.tolist() if success_probability is not None else None
+        }
+
+    def generate_optimized_schedule(self, ctx: PlanContext) -> Dict[str, Dict[str, Any]]:
         """Обновленная основная функция генерации расписания"""
-        return self.optimize_topic_selection(user_data)
+        return self.optimize_topic_selection(ctx)
 
-    def create_personalized_weekly_plan(self, schedule: Dict[str, Dict], user_data: UserData) -> List[Dict[str, Any]]:
+    def create_personalized_weekly_plan(self, schedule: Dict[str, Dict], ctx: PlanContext) -> List[Dict[str, Any]]:
         """Создание персонализированного недельного плана"""
-        exam_date = datetime.fromisoformat(user_data.examDate.replace('Z', '+00:00'))
-        current_date = datetime.now()
-        total_weeks = max(4, (exam_date - current_date).days // 7)
-        weekly_hours = user_data.availableHoursPerWeek
+        return list(self.iter_personalized_weekly_plan(schedule, ctx))
+
+    def iter_personalized_weekly_plan(self, schedule: Dict[str, Dict], ctx: PlanContext,
+                                      start_week: int = 1, total_weeks: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Персонализированный недельный план: каждая неделя отдается сразу после упаковки.
+
+        start_week и total_weeks позволяют упаковать только оставшиеся недели при перепланировании.
+        """
+        total_weeks = total_weeks or ctx.total_weeks
+        weekly_hours = ctx.user.availableHoursPerWeek
         
         # Получаем стратегию обучения
-        learning_strategy = self.learning_strategies[user_data.learningStyle]
-        difficulty_profile = self.difficulty_profiles[user_data.preferredDifficulty]
+        learning_strategy = ctx.learning_strategy
+        difficulty_profile = ctx.difficulty_profile
+        resources = self.resource_table
         
-        weekly_plans = []
+        # Распределяем темы по неделям с учетом зависимостей из графа тем
+        weeks = self.weekly_packer.pack(schedule, weekly_hours, total_weeks - start_week + 1, STANDARD_PACKING)
         
-        # Распределяем темы по неделям с учетом зависимостей
-        remaining_schedule = schedule.copy()
-        current_week = 1
-        
-        while remaining_schedule and current_week <= total_weeks:
+        for current_week, topics_for_week in enumerate(weeks, start=start_week):
             week_plan = {
                 'weekNumber': current_week,
                 'focusTopics': [],
                 'totalHours': 0,
                 'dailyBreakdown': [],
                 'learningActivities': [],
-                'goals': self._get_adaptive_weekly_goals(current_week, total_weeks, user_data),
+                'goals': self._get_adaptive_weekly_goals(current_week, total_weeks, ctx),
                 'practiceTests': [],
                 'resources': [],
                 'successMetrics': []
             }
             
-            current_week_hours = 0
-            
-            # Выбираем темы для текущей недели
-            topics_for_week = []
-            for topic_name, topic_info in list(remaining_schedule.items()):
-                if current_week_hours >= weekly_hours:
-                    break
-                    
-                # Проверяем зависимости
-                deps = topic_info.get('dependencies', [])
-                if not all(dep not in remaining_schedule for dep in deps):
-                    continue
-                
-                topic_hours = topic_info['allocated_hours']
-                hours_this_week = min(topic_hours, 8, weekly_hours - current_week_hours)
-                
-                if hours_this_week >= 2:
-                    topics_for_week.append((topic_name, hours_this_week, topic_info))
-                    current_week_hours += hours_this_week
-                    
-                    # Обновляем оставшееся время
-                    remaining_hours = topic_hours - hours_this_week
-                    if remaining_hours > 0:
-                        remaining_schedule[topic_name]['allocated_hours'] = remaining_hours
-                    else:
-                        del remaining_schedule[topic_name]
+            current_week_hours = sum(hours for _, hours, _ in topics_for_week)
+            week_resources: Dict[str, None] = {}
             
             # Создаем детальный план на неделю
             for topic_name, hours, topic_info in topics_for_week:
@@ -609,15 +2229,14 @@ class AdaptiveStudyPlanGenerator:
                 
                 # Создаем персонализированные активности
                 activities = self._create_topic_activities(
-                    topic_name, hours, user_data, learning_strategy, difficulty_profile
+                    topic_name, hours, ctx, learning_strategy, difficulty_profile
                 )
                 week_plan['learningActivities'].extend(activities)
                 
-                # Добавляем рекомендованные ресурсы
-                week_plan['resources'].extend(
-                    self._get_topic_resources(topic_name, user_data.learningStyle)
-                )
+                # Добавляем рекомендованные ресурсы (идентификаторы из словаря плана)
+                week_resources.update(dict.fromkeys(resources.ids('standard', ctx.user.learningStyle, topic_name)))
             
+            week_plan['resources'] = list(week_resources)
             week_plan['totalHours'] = current_week_hours
             
             # Добавляем пробные тесты и повторение
@@ -635,71 +2254,44 @@ class AdaptiveStudyPlanGenerator:
                     'duration': 3
                 })
             
-            weekly_plans.append(week_plan)
-            current_week += 1
-        
-        return weekly_plans
+            yield week_plan
 
-    def create_focused_weekly_plan(self, schedule: Dict[str, Dict], user_data: UserData) -> List[Dict[str, Any]]:
+    def create_focused_weekly_plan(self, schedule: Dict[str, Dict], ctx: PlanContext) -> List[Dict[str, Any]]:
         """Создает сфокусированный недельный план для продвинутых учеников"""
-        if user_data.currentScore <= 70:
-            return self.create_personalized_weekly_plan(schedule, user_data)
-        
-        exam_date = datetime.fromisoformat(user_data.examDate.replace('Z', '+00:00'))
-        current_date = datetime.now()
-        total_weeks = max(4, (exam_date - current_date).days // 7)
-        weekly_hours = user_data.availableHoursPerWeek
-        
-        learning_strategy = self.learning_strategies[user_data.learningStyle]
-        difficulty_profile = self.difficulty_profiles[user_data.preferredDifficulty]
-        
-        weekly_plans = []
-        remaining_schedule = schedule.copy()
-        current_week = 1
+        return list(self.iter_focused_weekly_plan(schedule, ctx))
+
+    def iter_focused_weekly_plan(self, schedule: Dict[str, Dict], ctx: PlanContext,
+                                 start_week: int = 1, total_weeks: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Сфокусированный недельный план: каждая неделя отдается сразу после упаковки"""
+        if ctx.user.currentScore <= 70:
+            yield from self.iter_personalized_weekly_plan(schedule, ctx, start_week, total_weeks)
+            return
+        
+        total_weeks = total_weeks or ctx.total_weeks
+        weekly_hours = ctx.user.availableHoursPerWeek
+        
+        learning_strategy = ctx.learning_strategy
+        difficulty_profile = ctx.difficulty_profile
+        resources = self.resource_table
+        
+        weeks = self.weekly_packer.pack(
+            schedule, weekly_hours, total_weeks - start_week + 1, focused_packing(ctx.user.currentScore)
+        )
         
-        while remaining_schedule and current_week <= total_weeks:
+        for current_week, topics_for_week in enumerate(weeks, start=start_week):
             week_plan = {
                 'weekNumber': current_week,
                 'focusTopics': [],
                 'totalHours': 0,
                 'learningActivities': [],
-                'goals': self._get_advanced_weekly_goals(current_week, total_weeks, user_data),
+                'goals': self._get_advanced_weekly_goals(current_week, total_weeks, ctx),
                 'practiceTests': [],
                 'resources': [],
-                'intensity': 'high' if user_data.currentScore > 80 else 'medium'
+                'intensity': 'high' if ctx.user.currentScore > 80 else 'medium'
             }
             
-            current_week_hours = 0
-            
-            # Для продвинутых: меньше тем, но более глубокое изучение
-            max_topics_per_week = 2 if user_data.currentScore > 80 else 3
-            
-            topics_for_week = []
-            for topic_name, topic_info in list(remaining_schedule.items()):
-                if (current_week_hours >= weekly_hours or 
-                    len(topics_for_week) >= max_topics_per_week):
-                    break
-                    
-                deps = topic_info.get('dependencies', [])
-                if not all(dep not in remaining_schedule for dep in deps):
-                    continue
-                
-                topic_hours = topic_info['allocated_hours']
-                # Для сложных тем выделяем больше времени за раз
-                if topic_info.get('complexity', 0) >= 4:
-                    hours_this_week = min(topic_hours, 10, weekly_hours - current_week_hours)
-                else:
-                    hours_this_week = min(topic_hours, 6, weekly_hours - current_week_hours)
-                
-                if hours_this_week >= 3:  # Минимум 3 часа на тему для продвинутых
-                    topics_for_week.append((topic_name, hours_this_week, topic_info))
-                    current_week_hours += hours_this_week
-                    
-                    remaining_hours = topic_hours - hours_this_week
-                    if remaining_hours > 0:
-                        remaining_schedule[topic_name]['allocated_hours'] = remaining_hours
-                    else:
-                        del remaining_schedule[topic_name]
+            current_week_hours = sum(hours for _, hours, _ in topics_for_week)
+            week_resources: Dict[str, None] = {}
             
             # Создаем углубленный план на неделю
             for topic_name, hours, topic_info in topics_for_week:
@@ -713,14 +2305,13 @@ class AdaptiveStudyPlanGenerator:
                 
                 # Более продвинутые активности
                 activities = self._create_advanced_topic_activities(
-                    topic_name, hours, user_data, learning_strategy, difficulty_profile
+                    topic_name, hours, ctx, learning_strategy, difficulty_profile
                 )
                 week_plan['learningActivities'].extend(activities)
                 
-                week_plan['resources'].extend(
-                    self._get_advanced_topic_resources(topic_name, user_data.learningStyle)
-                )
+                week_resources.update(dict.fromkeys(resources.ids('advanced', ctx.user.learningStyle, topic_name)))
             
+            week_plan['resources'] = list(week_resources)
             week_plan['totalHours'] = current_week_hours
             
             # Более частые пробные тесты для продвинутых
@@ -740,12 +2331,9 @@ class AdaptiveStudyPlanGenerator:
                     'difficulty': 'exam_level'
                 })
             
-            weekly_plans.append(week_plan)
-            current_week += 1
-        
-        return weekly_plans
+            yield week_plan
 
-    def _create_topic_activities(self, topic_name: str, hours: int, user_data: UserData, 
+    def _create_topic_activities(self, topic_name: str, hours: int, ctx: PlanContext, 
                                strategy: Dict, profile: Dict) -> List[Dict]:
         """Создает персонализированные учебные активности"""
         activities = []
@@ -774,12 +2362,12 @@ class AdaptiveStudyPlanGenerator:
             'duration': practice_hours,
             'methods': practice_methods,
             'exercises': f'Практические задания по {topic_name}',
-            'difficulty': user_data.preferredDifficulty.value
+            'difficulty': ctx.user.preferredDifficulty.value
         })
         
         return activities
 
-    def _create_advanced_topic_activities(self, topic_name: str, hours: int, user_data: UserData, 
+    def _create_advanced_topic_activities(self, topic_name: str, hours: int, ctx: PlanContext, 
                                         strategy: Dict, profile: Dict) -> List[Dict]:
         """Создает продвинутые учебные активности"""
         activities = []
@@ -810,11 +2398,11 @@ class AdaptiveStudyPlanGenerator:
         
         return activities
 
-    def _get_adaptive_weekly_goals(self, week: int, total_weeks: int, user_data: UserData) -> List[str]:
+    def _get_adaptive_weekly_goals(self, week: int, total_weeks: int, ctx: PlanContext) -> List[str]:
         """Адаптивные цели недели"""
         progress = week / total_weeks
-        current_level = user_data.currentScore
-        target_level = user_data.targetScore
+        current_level = ctx.user.currentScore
+        target_level = ctx.user.targetScore
         
         expected_progress = current_level + (target_level - current_level) * progress
         
@@ -843,11 +2431,11 @@ class AdaptiveStudyPlanGenerator:
                 "Психологическая подготовка"
             ]
 
-    def _get_advanced_weekly_goals(self, week: int, total_weeks: int, user_data: UserData) -> List[str]:
+    def _get_advanced_weekly_goals(self, week: int, total_weeks: int, ctx: PlanContext) -> List[str]:
         """Цели недели для продвинутых учеников"""
         progress = week / total_weeks
-        current_level = user_data.currentScore
-        target_level = user_data.targetScore
+        current_level = ctx.user.currentScore
+        target_level = ctx.user.targetScore
         
         expected_progress = current_level + (target_level - current_level) * progress
         
@@ -878,109 +2466,16 @@ class AdaptiveStudyPlanGenerator:
 
     def _get_topic_resources(self, topic_name: str, learning_style: LearningStyle) -> List[str]:
         """Персонализированные ресурсы для темы"""
-        base_resources = {
-            'common': [
-                "Сборник ФИПИ 2024",
-                "Типовые экзаменационные варианты",
-                "EGE Trainer - онлайн тренажер"
-            ],
-            'visual': [
-                "Интерактивные видеуроки",
-                "Анимированные объяснения",
-                "Графические схемы и диаграммы"
-            ],
-            'auditory': [
-                "Аудиолекции по теме",
-                "Подкасты с разбором задач",
-                "Обсуждения в учебных группах"
-            ],
-            'kinesthetic': [
-                "Интерактивные симуляции",
-                "Практические эксперименты",
-                "Физические модели и макеты"
-            ],
-            'reading_writing': [
-                "Детальные конспекты",
-                "Письменные упражнения",
-                "Аналитические задания"
-            ]
-        }
-        
-        resources = base_resources['common'] + base_resources[learning_style.value]
-        
-        # Специфические ресурсы для тем
-        topic_specific = {
-            'Геометрия': ['3D-визуализатор', 'Геометрический конструктор'],
-            'Тригонометрия': ['Тригонометрический круг', 'Анимированные графики'],
-            'Производная': ['Графический анализатор', 'Интерактивные пределы'],
-            'Вероятность': ['Вероятностные симуляции', 'Статистические визуализации']
-        }
-        
-        for key, additional_resources in topic_specific.items():
-            if key.lower() in topic_name.lower():
-                resources.extend(additional_resources)
-        
-        return resources
+        return self.resource_table.titles(self.resource_table.ids('standard', learning_style, topic_name))
 
     def _get_advanced_topic_resources(self, topic_name: str, learning_style: LearningStyle) -> List[str]:
         """Ресурсы для продвинутых учеников"""
-        base_advanced_resources = {
-            'common': [
-                "Сборник олимпиадных задач",
-                "Углубленный курс математики",
-                "Задачи с параметрами (продвинутый уровень)",
-                "Методы доказательств в математике"
-            ],
-            'visual': [
-                "Продвинутые визуализации",
-                "Интерактивные 3D-модели сложных концепций",
-                "Анимации доказательств"
-            ],
-            'auditory': [
-                "Лекции ведущих математиков",
-                "Обсуждения сложных задач",
-                "Подкасты о математических методах"
-            ],
-            'kinesthetic': [
-                "Сложные интерактивные симуляции",
-                "Практика доказательств на доске",
-                "Решение нестандартных задач"
-            ],
-            'reading_writing': [
-                "Научные статьи по теме",
-                "Ведение математического дневника",
-                "Анализ сложных решений"
-            ]
-        }
-        
-        resources = base_advanced_resources['common'] + base_advanced_resources[learning_style.value]
-        
-        # Специфические продвинутые ресурсы
-        advanced_topic_specific = {
-            'Параметры': [
-                'Методы исследования функций с параметрами',
-                'Графические методы решения параметрических задач'
-            ],
-            'Стереометрия': [
-                'Сложные пространственные конструкции',
-                'Методы координат в пространстве'
-            ],
-            'Производная': [
-                'Приложения производной в физике',
-                'Оптимизационные задачи повышенной сложности'
-            ]
-        }
-        
-        for key, additional_resources in advanced_topic_specific.items():
-            if key.lower() in topic_name.lower():
-                resources.extend(additional_resources)
-        
-        return resources
+        return self.resource_table.titles(self.resource_table.ids('advanced', learning_style, topic_name))
 
-    def _get_personalized_approach_v2(self, user_data: UserData) -> str:
+    def _get_personalized_approach_v2(self, ctx: PlanContext) -> str:
         """Улучшенный персонализированный подход"""
-        score_gap = user_data.targetScore - user_data.currentScore
-        available_time = user_data.availableHoursPerWeek
+        score_gap = ctx.user.targetScore - ctx.user.currentScore
+        available_time = ctx.user.availableHoursPerWeek
         
         approaches = []
         
@@ -996,14 +2491,14 @@ class AdaptiveStudyPlanGenerator:
         elif available_time > 15:
             approaches.append("Глубокое погружение с расширенной практикой")
         
-        if user_data.learningStyle == LearningStyle.VISUAL:
+        if ctx.user.learningStyle == LearningStyle.VISUAL:
             approaches.append("Визуальное обучение с графиками и диаграммами")
-        elif user_data.learningStyle == LearningStyle.KINESTHETIC:
+        elif ctx.user.learningStyle == LearningStyle.KINESTHETIC:
             approaches.append("Практико-ориентированный подход с интерактивными заданиями")
         
         return ". ".join(approaches)
 
-    def _get_personalized_resources_v2(self, user_data: UserData) -> List[Dict[str, Any]]:
+    def _get_personalized_resources_v2(self, ctx: PlanContext) -> List[Dict[str, Any]]:
         """Улучшенная система рекомендации ресурсов"""
         resources = []
         
@@ -1014,7 +2509,7 @@ class AdaptiveStudyPlanGenerator:
         })
         
         # Ресурсы по стилю обучения
-        style_resources = self.learning_strategies[user_data.learningStyle]['resources']
+        style_resources = self.learning_strategies[ctx.user.learningStyle]['resources']
         resources.append({
             'category': 'learning_style',
             'items': style_resources
@@ -1022,11 +2517,11 @@ class AdaptiveStudyPlanGenerator:
         
         # Тематические ресурсы для слабых областей
         weak_areas_resources = []
-        for area in user_data.weakAreas[:3]:
-            if user_data.currentScore > 70:
-                area_resources = self._get_advanced_topic_resources(area, user_data.learningStyle)
+        for area in ctx.user.weakAreas[:3]:
+            if ctx.user.currentScore > 70:
+                area_resources = self._get_advanced_topic_resources(area, ctx.user.learningStyle)
             else:
-                area_resources = self._get_topic_resources(area, user_data.learningStyle)
+                area_resources = self._get_topic_resources(area, ctx.user.learningStyle)
             weak_areas_resources.extend(area_resources[:2])  # Берем по 2 лучших ресурса
         
         resources.append({
@@ -1036,7 +2531,7 @@ class AdaptiveStudyPlanGenerator:
         
         # Дополнительные ресурсы
         additional = ['EGE Trainer - онлайн тренажер', 'Мобильное приложение для повторения']
-        if user_data.targetScore > 80:
+        if ctx.user.targetScore > 80:
             additional.append('Задачи олимпиадного уровня')
         
         resources.append({
@@ -1046,17 +2541,17 @@ class AdaptiveStudyPlanGenerator:
         
         return resources
 
-    def _generate_smart_milestones_v2(self, user_data: UserData, total_weeks: int) -> List[Dict[str, Any]]:
+    def _generate_smart_milestones_v2(self, ctx: PlanContext, total_weeks: int) -> List[Dict[str, Any]]:
         """Умные контрольные точки с адаптацией"""
         milestones = []
-        score_gap = user_data.targetScore - user_data.currentScore
+        score_gap = ctx.user.targetScore - ctx.user.currentScore
         
         # Динамическое распределение вех
         checkpoints = [0.25, 0.5, 0.75, 0.9]
         
         for i, checkpoint in enumerate(checkpoints):
             week = max(i + 2, int(total_weeks * checkpoint))
-            target_score = user_data.currentScore + score_gap * checkpoint
+            target_score = ctx.user.currentScore + score_gap * checkpoint
             
             milestone_types = ['foundation', 'progress', 'mastery', 'excellence']
             
@@ -1065,7 +2560,7 @@ class AdaptiveStudyPlanGenerator:
                 'targetScore': int(target_score),
                 'description': self._get_milestone_description(milestone_types[i], target_score),
                 'type': milestone_types[i],
-                'keyTopics': self._get_milestone_topics(user_data, checkpoint)
+                'keyTopics': self._get_milestone_topics(ctx, checkpoint)
             })
         
         return milestones
@@ -1080,7 +2575,7 @@ class AdaptiveStudyPlanGenerator:
         }
         return descriptions.get(milestone_type, 'Контрольная точка')
 
-    def _get_milestone_topics(self, user_data: UserData, progress: float) -> List[str]:
+    def _get_milestone_topics(self, ctx: PlanContext, progress: float) -> List[str]:
         """Ключевые темы для контрольной точки"""
         if progress <= 0.25:
             return ['Базовые навыки', 'Простые уравнения', 'Геометрия начального уровня']
@@ -1091,24 +2586,37 @@ class AdaptiveStudyPlanGenerator:
         else:
             return ['Задачи с параметрами', 'Сложные уравнения', 'Оптимизационные задачи']
 
-    def _estimate_score_progression(self, user_data: UserData, total_weeks: int) -> List[Dict[str, Any]]:
-        """Оценка прогресса баллов по неделям"""
-        progression = []
-        current_score = user_data.currentScore
-        target_score = user_data.targetScore
-        weekly_improvement = (target_score - current_score) / total_weeks
-        
-        for week in range(total_weeks + 1):
-            estimated_score = current_score + (weekly_improvement * week)
-            # Добавляем случайную вариацию для реалистичности
-            variation = np.random.normal(0, 2)
-            estimated_score = max(current_score, min(target_score, estimated_score + variation))
-            
-            progression.append({
-                'week': week,
-                'estimatedScore': round(estimated_score, 1),
-                'confidence': max(0.5, 0.8 - (week * 0.02))  # Уверенность снижается со временем
-            })
+    def _estimate_score_progression(self, ctx: PlanContext, total_weeks: int,
+                                    rng: np.random.Generator, simulations: int = 0) -> List[Dict[str, Any]]:
+        """Оценка прогресса баллов по неделям: шум для всех недель берется одной выборкой.
+
+        При simulations > 0 к каждой неделе добавляются перцентили p10/p50/p90
+        по simulations смоделированным траекториям.
+        """
+        current_score = ctx.user.currentScore
+        target_score = ctx.user.targetScore
+        weeks = np.arange(total_weeks + 1)
+        trend = current_score + (target_score - current_score) / total_weeks * weeks
+        
+        # Случайная вариация для реалистичности, балл остается между текущим и целевым
+        estimated = np.maximum(current_score, np.minimum(target_score, trend + rng.normal(0, 2, size=weeks.size)))
+        confidence = np.maximum(0.5, 0.8 - weeks * 0.02)  # Уверенность снижается со временем
+        progression = [
+            {'week': week, 'estimatedScore': score, 'confidence': level}
+            for week, score, level in zip(weeks.tolist(), estimated.round(1).tolist(), confidence.tolist())
+        ]
+        
+        if simulations > 0:
+            # Перцентили считаются по блокам недель: матрица траекторий не больше
+            # SIMULATION_BATCH_TRAJECTORIES значений при любом горизонте
+            chunk_weeks = max(1, SIMULATION_BATCH_TRAJECTORIES // simulations)
+            for start in range(0, weeks.size, chunk_weeks):
+                chunk_trend = trend[start:start + chunk_weeks]
+                noise = rng.normal(0, 2, size=(simulations, chunk_trend.size))
+                trajectories = np.maximum(current_score, np.minimum(target_score, chunk_trend + noise))
+                bands = np.percentile(trajectories, [10, 50, 90], axis=0).round(1)
+                for point, p10, p50, p90 in zip(progression[start:start + chunk_weeks], *bands.tolist()):
+                    point.update(p10=p10, p50=p50, p90=p90)
         
         return progression
 
@@ -1123,25 +2631,28 @@ class AdaptiveStudyPlanGenerator:
         else:
             return "начальный"
 
-    def _generate_plan_analytics(self, schedule: Dict, weekly_plan: List, user_data: UserData, 
-                               learning_gaps: Dict) -> Dict[str, Any]:
+    def _generate_plan_analytics(self, schedule: Dict, ctx: PlanContext) -> Dict[str, Any]:
         """Генерация аналитики по плану"""
         total_hours = sum(topic['allocated_hours'] for topic in schedule.values())
-        critical_topics_coverage = len([t for t in learning_gaps['critical'] if t in schedule])
+        # Пробел покрыт, если в план попала хотя бы одна из сопоставленных ему тем
+        critical_gaps = ctx.learning_gaps['critical']
+        critical_topics_coverage = len([
+            area for area in critical_gaps if any(topic in schedule for topic in ctx.area_topics[area])
+        ])
         
         return {
-            'planEfficiency': self._calculate_plan_efficiency(schedule, user_data),
+            'planEfficiency': self._calculate_plan_efficiency(schedule, ctx),
             'coverageMetrics': {
-                'criticalGapsCovered': f"{critical_topics_coverage}/{len(learning_gaps['critical'])}",
+                'criticalGapsCovered': f"{critical_topics_coverage}/{len(critical_gaps)}",
                 'totalTopicsCovered': len(schedule),
                 'totalHoursAllocated': total_hours
             },
             'difficultyDistribution': self._analyze_difficulty_distribution(schedule),
-            'riskAssessment': self._assess_plan_risks(schedule, user_data),
-            'successProbability': self._calculate_success_probability(user_data)
+            'riskAssessment': self._assess_plan_risks(schedule, ctx),
+            'successProbability': self._calculate_success_probability(ctx)
         }
 
-    def _calculate_plan_efficiency(self, schedule: Dict, user_data: UserData) -> float:
+    def _calculate_plan_efficiency(self, schedule: Dict, ctx: PlanContext) -> float:
         """Расчет эффективности плана"""
         total_priority = sum(topic['priority'] for topic in schedule.values())
         max_possible_priority = len(schedule) * 300  # Максимальный теоретический приоритет
@@ -1149,165 +2660,989 @@ class AdaptiveStudyPlanGenerator:
         efficiency = total_priority / max_possible_priority if max_possible_priority > 0 else 0
         return min(1.0, efficiency * 1.2)  # Нормализуем до 0-1
 
-    def _calculate_success_probability(self, user_data: UserData) -> float:
-        """Расчет вероятности успеха"""
-        base_probability = 0.5
-        
-        # Фактор разницы баллов
-        score_gap = user_data.targetScore - user_data.currentScore
-        if score_gap <= 10:
-            base_probability += 0.3
-        elif score_gap <= 20:
-            base_probability += 0.2
-        elif score_gap <= 30:
-            base_probability += 0.1
-        
-        # Фактор времени
-        exam_date = datetime.fromisoformat(user_data.examDate.replace('Z', '+00:00'))
-        days_until_exam = (exam_date - datetime.now()).days
-        if days_until_exam >= 90:
-            base_probability += 0.2
-        elif days_until_exam >= 60:
-            base_probability += 0.1
-        
-        # Фактор мотивации
-        base_probability += (user_data.motivationLevel - 5) * 0.03
-        
-        return min(0.95, max(0.3, base_probability))
+    def _calculate_success_probability(self, ctx: PlanContext) -> float:
+        """Расчет вероятности успеха: интерполяция по таблице симуляции, без нее - ступенчатая оценка"""
+        if success_table is not None:
+            return success_table.probability(
+                ctx.user.currentScore, ctx.user.targetScore, ctx.user.availableHoursPerWeek,
+                ctx.total_weeks, ctx.user.motivationLevel
+            )
+        return step_success_probability(
+            ctx.user.currentScore, ctx.user.targetScore, ctx.days_until_exam, ctx.user.motivationLevel
+        )
 
     def _analyze_difficulty_distribution(self, schedule: Dict) -> Dict[str, int]:
         """Анализ распределения сложности тем"""
         distribution = {'easy': 0, 'medium': 0, 'hard': 0}
         
         for topic_name in schedule.keys():
-            # Находим тему в базе знаний
-            for category in EGE_MATH_TOPICS.values():
-                for topic in category:
-                    if topic['name'] == topic_name:
-                        if topic['complexity'] <= 2:
-                            distribution['easy'] += 1
-                        elif topic['complexity'] <= 4:
-                            distribution['medium'] += 1
-                        else:
-                            distribution['hard'] += 1
-                        break
+            # Темы вне базы знаний (добавленные сложные темы) не учитываются
+            bucket = self.catalog.difficulty_bucket(topic_name)
+            if bucket is not None:
+                distribution[bucket] += 1
         
         return distribution
 
-    def _assess_plan_risks(self, schedule: Dict, user_data: UserData) -> List[str]:
+    def _assess_plan_risks(self, schedule: Dict, ctx: PlanContext) -> List[str]:
         """Оценка рисков плана"""
         risks = []
         
         if len(schedule) > 20:
             risks.append("Высокая нагрузка: много тем для изучения")
         
-        if user_data.availableHoursPerWeek < 8:
+        if ctx.user.availableHoursPerWeek < 8:
             risks.append("Недостаточно времени для качественной подготовки")
         
         # Проверяем наличие сложных тем для начинающих
-        if user_data.currentScore < 50:
-            hard_topics = [t for t in schedule if any(
-                topic['name'] == t and topic['complexity'] >= 4 
-                for category in EGE_MATH_TOPICS.values() for topic in category
-            )]
+        if ctx.user.currentScore < 50:
+            hard_topics = [t for t in schedule if (self.catalog.complexity(t) or 0) >= 4]
             if hard_topics:
                 risks.append("Сложные темы могут быть трудны для освоения")
         
         return risks
 
-    def generate_advanced_study_plan(self, user_data: UserData) -> Dict[str, Any]:
+    def generate_advanced_study_plan(self, user_data: UserData,
+                                     spans: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
         """Основная функция генерации расширенного учебного плана"""
+        plan: Dict[str, Any] = {}
+        weekly_plan = []
+        for part, payload in self.iter_advanced_study_plan(user_data, spans):
+            if part == 'week':
+                weekly_plan.append(payload)
+            else:
+                plan.update(payload)
+        plan['weeklySchedule'] = weekly_plan
+        return plan
+
+    def iter_advanced_study_plan(self, user_data: UserData,
+                                 spans: Optional[Dict[str, float]] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Поэтапная генерация плана: заголовок, затем недели по мере упаковки, аналитика последней.
+
+        В spans (если передан) записывается время этапов по монотонным часам, в секундах.
+        """
+        spans = spans if spans is not None else {}
         logger.info(f"Генерация плана для пользователя {user_data.userId} (уровень: {user_data.currentScore})")
         
-        exam_date = datetime.fromisoformat(user_data.examDate.replace('Z', '+00:00'))
-        current_date = datetime.now()
-        total_weeks = max(4, (exam_date - current_date).days // 7)
-        total_hours = total_weeks * user_data.availableHoursPerWeek
+        # Контекст запроса: даты, пробелы и множители, общие для всех этапов
+        stage_start = time.perf_counter()
+        ctx = self.build_context(user_data)
+        spans['gap_analysis'] = time.perf_counter() - stage_start
+        total_weeks = ctx.total_weeks
         
-        # Анализ данных пользователя
-        learning_gaps = self.analyze_learning_gaps(user_data)
+        # Случайность плана детерминирована ключом кэша
+        rng = np.random.default_rng(plan_seed(ctx.cache_key))
         
         # Генерация оптимизированного расписания
-        schedule = self.optimize_topic_selection(user_data)
+        stage_start = time.perf_counter()
+        schedule = self.optimize_topic_selection(ctx)
+        spans['topic_selection'] = time.perf_counter() - stage_start
         
-        # Создание недельного плана
-        if user_data.currentScore > 70:
-            weekly_plan = self.create_focused_weekly_plan(schedule, user_data)
+        # Выбор недельного планировщика
+        if ctx.advanced:
+            weeks = self.iter_focused_weekly_plan(schedule, ctx)
             plan_type = "advanced_focused"
         else:
-            weekly_plan = self.create_personalized_weekly_plan(schedule, user_data)
+            weeks = self.iter_personalized_weekly_plan(schedule, ctx)
             plan_type = "personalized"
+        resource_level = 'advanced' if ctx.advanced else 'standard'
+        
+        yield 'header', {
+            'planId': f"plan_{ctx.user.userId}_{int(ctx.now.timestamp())}",
+            'durationWeeks': total_weeks,
+            'totalStudyHours': ctx.total_hours,
+            'topicDistribution': schedule,
+            'studyFocus': {
+                'priorityTopics': list(ctx.learning_gaps['critical'][:5]),
+                'strongAreas': ctx.user.strongAreas,
+                'learningGaps': {level: list(areas) for level, areas in ctx.learning_gaps.items()},
+                'recommendedApproach': self._get_personalized_approach_v2(ctx),
+                'learningStrategy': self.learning_strategies[ctx.user.learningStyle],
+                'planType': plan_type,
+                'studentLevel': self._get_student_level(ctx.user.currentScore)
+            },
+            'resources': self._get_personalized_resources_v2(ctx),
+            'resourceCatalog': self.resource_table.plan_catalog(resource_level, ctx.user.learningStyle, schedule),
+            'milestones': self._generate_smart_milestones_v2(ctx, total_weeks),
+            'totalTopics': len(schedule),
+            'averageHoursPerWeek': ctx.user.availableHoursPerWeek
+        }
+        
+        # Время упаковки учитывает только работу генератора недель, без потребителя
+        spans['weekly_packing'] = 0.0
+        while True:
+            stage_start = time.perf_counter()
+            week_plan = next(weeks, None)
+            spans['weekly_packing'] += time.perf_counter() - stage_start
+            if week_plan is None:
+                break
+            yield 'week', week_plan
         
         # Аналитика и метрики
-        analytics = self._generate_plan_analytics(schedule, weekly_plan, user_data, learning_gaps)
+        stage_start = time.perf_counter()
+        tail = {
+            'analytics': self._generate_plan_analytics(schedule, ctx),
+            'estimatedScoreProgress': self._estimate_score_progression(
+                ctx, total_weeks, rng, progression_simulations(ctx.user)
+            )
+        }
+        spans['analytics'] = time.perf_counter() - stage_start
+        yield 'analytics', tail
+
+    def replan(self, previous_plan: Dict[str, Any], user_data: UserData, completed_weeks: int,
+               spans: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        """Инкрементальное перепланирование: пройденные недели сохраняются как есть,
+        пересчитываются только изменившиеся приоритеты и оставшиеся недели
+        """
+        spans = spans if spans is not None else {}
+        total_weeks = previous_plan['durationWeeks']
+        frozen_weeks = previous_plan['weeklySchedule'][:completed_weeks]
+        remaining_weeks = total_weeks - completed_weeks
+        
+        # Часы, уже пройденные в замороженных неделях
+        done_hours: Dict[str, int] = {}
+        for week in frozen_weeks:
+            for topic in week['focusTopics']:
+                done_hours[topic['name']] = done_hours.get(topic['name'], 0) + topic['hours']
+        
+        # Пересчет приоритетов векторно по каталогу; изменившимися считаются темы плана,
+        # чей новый приоритет отличается от записанного в прежнем распределении.
+        # currentScore входит в приоритет только через уровень (границы 40/60/80): новый балл
+        # в том же диапазоне ничего не меняет, переход в другой меняет приоритет всех тем
+
+        stage_start = time.perf_counter()
+        ctx = self.build_context(user_data)
+        new_priorities, estimated_times = self.score_catalog(ctx)
+        new_priorities = new_priorities.tolist()
+        changed: Dict[str, float] = {}
+        for name, info in previous_plan['topicDistribution'].items():
+            position = self.catalog.positions.get(name)
+            if position is not None:
+                priority = new_priorities[position]
+            elif name in ADVANCED_TARGET_RECORDS:
+                priority = self.calculate_adaptive_priority(ADVANCED_TARGET_RECORDS[name], ctx)
+            else:
+                continue
+            if not math.isclose(priority, info['priority'], rel_tol=1e-9):
+                changed[name] = priority
+        spans['gap_analysis'] = time.perf_counter() - stage_start
+        
+        # Остаток расписания: невыученные часы, изменившиеся темы масштабируются по приоритету
+        stage_start = time.perf_counter()
+        budget = remaining_weeks * ctx.user.availableHoursPerWeek
+        remaining: Dict[str, Dict[str, Any]] = {}
+        for name, info in previous_plan['topicDistribution'].items():
+            left = info['allocated_hours'] - done_hours.get(name, 0)
+            if name in changed and info['priority'] > 0:
+                left = int(round(left * changed[name] / info['priority']))
+            # Вместе с пройденными часами тема не выходит за свой предел
+            left = min(left, max_topic_hours(info['complexity'], ctx.advanced) - done_hours.get(name, 0))
+            if left > 0:
+                remaining[name] = {**info, 'allocated_hours': left, 'priority': changed.get(name, info['priority'])}
+        
+        # Остаток больше бюджета оставшихся недель - часы тем уменьшаются пропорционально
+        remaining_total = sum(info['allocated_hours'] for info in remaining.values())
+        if remaining_total > budget:
+            scale = budget / remaining_total
+            remaining = {
+                name: {**info, 'allocated_hours': int(info['allocated_hours'] * scale)}
+                for name, info in remaining.items()
+                if int(info['allocated_hours'] * scale) > 0
+            }
+        
+        # Новые критические пробелы добавляются, если на них хватает оставшегося времени
+        spare = budget - sum(info['allocated_hours'] for info in remaining.values())
+        critical_topics = dict.fromkeys(
+            topic for area in ctx.learning_gaps['critical'] for topic in ctx.area_topics[area]
+        )
+        for name in critical_topics:
+            record = self.catalog.get(name)
+            if record is None or name in remaining or name in done_hours:
+                continue
+            position = self.catalog.positions[name]
+            hours = int(estimated_times[position])
+            if hours <= spare:
+                remaining[name] = {
+                    'allocated_hours': hours,
+                    'priority': new_priorities[position],
+                    'category': record.category,
+                    'week_distribution': [],
+                    'complexity': record.complexity
+                }
+                spare -= hours
+        remaining = dict(sorted(remaining.items(), key=lambda item: -item[1]['priority']))
+        spans['topic_selection'] = time.perf_counter() - stage_start
+        
+        stage_start = time.perf_counter()
+        if ctx.advanced:
+            weeks = self.iter_focused_weekly_plan(remaining, ctx, completed_weeks + 1, total_weeks)
+            plan_type = "advanced_focused"
+        else:
+            weeks = self.iter_personalized_weekly_plan(remaining, ctx, completed_weeks + 1, total_weeks)
+            plan_type = "personalized"
+        resource_level = 'advanced' if ctx.advanced else 'standard'
+        weekly_plan = frozen_weeks + list(weeks)
+        spans['weekly_packing'] = time.perf_counter() - stage_start
+        
+        # Итоговое распределение: пройденные часы плюс оставшиеся
+        distribution = {}
+        for name in dict.fromkeys([*done_hours, *remaining]):
+            base = remaining.get(name) or previous_plan['topicDistribution'][name]
+            hours = done_hours.get(name, 0) + (remaining[name]['allocated_hours'] if name in remaining else 0)
+            distribution[name] = {**base, 'allocated_hours': hours}
+        
+        stage_start = time.perf_counter()
+        rng = np.random.default_rng(plan_seed(ctx.cache_key))
+        # Без оставшихся недель остается только точка текущей недели
+        progression = [
+            {**point, 'week': point['week'] + completed_weeks}
+            for point in self._estimate_score_progression(
+                ctx, max(1, remaining_weeks), rng, progression_simulations(ctx.user)
+            )
+            if point['week'] + completed_weeks <= total_weeks
+        ]
+        analytics = self._generate_plan_analytics(distribution, ctx)
+        spans['analytics'] = time.perf_counter() - stage_start
         
         return {
-            'planId': f"plan_{user_data.userId}_{int(datetime.now().timestamp())}",
-            'durationWeeks': total_weeks,
-            'totalStudyHours': total_hours,
-            'weeklySchedule': weekly_plan,
-            'topicDistribution': schedule,
+            **previous_plan,
+            'planId': f"plan_{ctx.user.userId}_{int(ctx.now.timestamp())}",
+            'topicDistribution': distribution,
             'studyFocus': {
-                'priorityTopics': learning_gaps['critical'][:5],
-                'strongAreas': user_data.strongAreas,
-                'learningGaps': learning_gaps,
-                'recommendedApproach': self._get_personalized_approach_v2(user_data),
-                'learningStrategy': self.learning_strategies[user_data.learningStyle],
+                **previous_plan['studyFocus'],
+                'priorityTopics': list(ctx.learning_gaps['critical'][:5]),
+                'strongAreas': ctx.user.strongAreas,
+                'learningGaps': {level: list(areas) for level, areas in ctx.learning_gaps.items()},
                 'planType': plan_type,
-                'studentLevel': self._get_student_level(user_data.currentScore)
+                'studentLevel': self._get_student_level(ctx.user.currentScore)
+            },
+            'resourceCatalog': {
+                **previous_plan.get('resourceCatalog', {}),
+                **self.resource_table.plan_catalog(resource_level, ctx.user.learningStyle, remaining)
             },
-            'resources': self._get_personalized_resources_v2(user_data),
-            'milestones': self._generate_smart_milestones_v2(user_data, total_weeks),
+            'totalTopics': len(distribution),
             'analytics': analytics,
-            'totalTopics': len(schedule),
-            'averageHoursPerWeek': user_data.availableHoursPerWeek,
-            'estimatedScoreProgress': self._estimate_score_progression(user_data, total_weeks)
+            'estimatedScoreProgress': [
+                point for point in previous_plan.get('estimatedScoreProgress', [])
+                if point['week'] < completed_weeks
+            ] + progression,
+            'weeklySchedule': weekly_plan,
+            'replan': {
+                'basePlanId': previous_plan.get('planId'),
+                'completedWeeks': completed_weeks,
+                'changedTopics': sorted(changed)
+            }
         }
 
 # Инициализация улучшенного генератора
 advanced_generator = AdaptiveStudyPlanGenerator()
+plan_cache = PlanCache(PLAN_CACHE_SIZE, PLAN_CACHE_TTL)
+plan_store = PlanCache(PLAN_STORE_SIZE, PLAN_STORE_TTL)
+
+# Метрики сервиса
+metrics = MetricsRegistry()
+http_requests_total = metrics.register(Counter(
+    "ege_http_requests_total", "Число HTTP-запросов", ("path", "method", "status")))
+http_request_errors_total = metrics.register(Counter(
+    "ege_http_request_errors_total", "Число запросов, завершившихся ошибкой сервера", ("path",)))
+http_requests_in_flight = metrics.register(Gauge(
+    "ege_http_requests_in_flight", "Запросы в обработке", ("path",)))
+plan_stage_duration_seconds = metrics.register(Histogram(
+    "ege_plan_stage_duration_seconds", "Время этапов генерации плана",
+    ("stage", "plan_type", "score_band")))
+plan_generation_duration_seconds = metrics.register(Histogram(
+    "ege_plan_generation_duration_seconds", "Полное время генерации плана",
+    ("plan_type", "score_band")))
+
+def observe_plan_timings(plan_type: str, current_score: float, processing_time: float,
+                         spans: Dict[str, float]):
+    """Записывает время этапов сгенерированного плана в гистограммы"""
+    band = score_band(current_score)
+    for stage, duration in spans.items():
+        plan_stage_duration_seconds.observe(duration, stage, plan_type, band)
+    plan_generation_duration_seconds.observe(processing_time, plan_type, band)
+
+def observe_plan_response(response: StudyPlanResponse, user_data: UserData):
+    analytics = response.analytics or {}
+    observe_plan_timings(response.plan.studyFocus.planType, user_data.currentScore,
+                         analytics.get('processingTime', 0.0), analytics.get('stageTimings', {}))
+
+def route_label(request: Request) -> str:
+    """Шаблон маршрута для меток метрик: число серий не зависит от присланных URL, прочие пути - 'other'"""
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match != Match.NONE:
+            return route.path
+    return "other"
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    path = route_label(request)
+    http_requests_in_flight.inc(path)
+    try:
+        response = await call_next(request)
+    except Exception:
+        http_request_errors_total.inc(path)
+        http_requests_total.inc(path, request.method, "500")
+        raise
+    finally:
+        http_requests_in_flight.dec(path)
+    if response.status_code >= 500:
+        http_request_errors_total.inc(path)
+    http_requests_total.inc(path, request.method, str(response.status_code))
+    return response
+
+def build_study_plan_response(generator: AdaptiveStudyPlanGenerator, user_data: UserData) -> StudyPlanResponse:
+    """Генерирует план, рекомендации и упаковывает их в ответ API"""
+    start_time = time.perf_counter()
+    spans: Dict[str, float] = {}
+    
+    plan = generator.generate_advanced_study_plan(user_data, spans)
+    
+    # Генерация рекомендаций
+    stage_start = time.perf_counter()
+    recommendations = generate_smart_recommendations(user_data, plan)
+    spans['recommendations'] = time.perf_counter() - stage_start
+    
+    processing_time = time.perf_counter() - start_time
+    
+    return StudyPlanResponse(
+        success=True,
+        plan=plan,
+        recommendations=recommendations,
+        confidence=plan['analytics']['successProbability'],
+        generatedBy="advanced_ml_system_v2",
+        planId=plan['planId'],
+        analytics={
+            'processingTime': processing_time,
+            'stageTimings': spans,
+            'planComplexity': 'high',
+            'personalizationLevel': 'advanced'
+        }
+    )
+
+# Пулы исполнителей для генерации планов.
+# Каждый процесс-воркер строит свой генератор один раз при старте, а не на каждую задачу.
+_worker_generator: Optional[AdaptiveStudyPlanGenerator] = None
+_plan_executor: Optional[Executor] = None
+_batch_executor: Optional[ProcessPoolExecutor] = None
+
+def _init_plan_worker():
+    """Инициализация процесса-воркера генерации"""
+    global _worker_generator, success_table
+    # Таблицу читаем заново: при fork воркер иначе унаследует ту, что была до активации
+    success_table = load_success_table(SUCCESS_TABLE_PATH)
+    _worker_generator = AdaptiveStudyPlanGenerator()
+
+def _generate_plan_job(user_data: UserData) -> StudyPlanResponse:
+    """Генерация одного плана внутри исполнителя"""
+    return build_study_plan_response(_worker_generator or advanced_generator, user_data)
+
+def _stream_plan_job(user_data: UserData) -> Tuple[List[Tuple[str, Dict[str, Any]]], Dict[str, float]]:
+    """Все части потокового плана одним заданием: генератор нельзя передать в другой процесс"""
+    spans: Dict[str, float] = {}
+    parts = list((_worker_generator or advanced_generator).iter_advanced_study_plan(user_data, spans))
+    return parts, spans
+
+def _sweep_job(profile: UserData, hours_options: List[int], target_options: List[float]) -> Dict[str, Any]:
+    """Сравнение вариантов внутри исполнителя"""
+    return (_worker_generator or advanced_generator).sweep(profile, hours_options, target_options)
+
+def _replan_job(previous_plan: Dict[str, Any], user_data: UserData, completed_weeks: int) -> StudyPlanResponse:
+    """Перепланирование внутри исполнителя"""
+    return build_replan_response(_worker_generator or advanced_generator, previous_plan, user_data, completed_weeks)
+
+def _profiled_generate_plan_job(user_data: UserData) -> StudyPlanResponse:
+    """Генерация одного плана под детерминированным профилировщиком"""
+    profiler = cProfile.Profile()
+    response = profiler.runcall(_generate_plan_job, user_data)
+    stats = pstats.Stats(profiler)
+    
+    functions = []
+    for (filename, line, function), (primitive_calls, calls, total_time, cumulative_time, _) in stats.stats.items():
+        functions.append({
+            'function': f"{os.path.basename(filename)}:{line}({function})",
+            'calls': calls,
+            'primitiveCalls': primitive_calls,
+            'totalTime': total_time,
+            'cumulativeTime': cumulative_time
+        })
+    functions.sort(key=lambda item: item['cumulativeTime'], reverse=True)
+    profile = {
+        'profiler': 'cProfile',
+        'totalTime': stats.total_tt,
+        'functions': functions[:PLAN_PROFILE_TOP]
+    }
+    
+    if PLAN_PROFILE_DIR:
+        os.makedirs(PLAN_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PLAN_PROFILE_DIR, f"{response.planId}_{time.time_ns()}.prof")
+        stats.dump_stats(path)
+        profile['file'] = path
+    
+    response.analytics = {**(response.analytics or {}), 'profile': profile}
+    return response
+
+# Поля UserData, которые в CSV записываются списком: JSON-массив или значения через ';'
+CSV_LIST_FIELDS = ('weakAreas', 'strongAreas', 'focusAreas')
+
+def csv_user_record(row: Mapping[str, Any]) -> Dict[str, Any]:
+    """Строка CSV в поля UserData: пустые ячейки опускаются (значения по умолчанию), списки и testResults разбираются"""
+    record: Dict[str, Any] = {}
+    for key, value in row.items():
+        text = value.strip() if isinstance(value, str) else value
+        if key in CSV_LIST_FIELDS:
+            if not text:
+                value = []
+            elif text.startswith('['):
+                value = json.loads(text)
+            else:
+                value = [item.strip() for item in text.split(';') if item.strip()]
+        elif key == 'testResults':
+            value = json.loads(text) if text else {}
+        elif text == '' or text is None:
+            continue
+        record[key] = value
+    return record
+
+def _init_bulk_worker():
+    """Воркер офлайн-генерации: без построчных INFO-логов генератора"""
+    logging.disable(logging.INFO)
+    _init_plan_worker()
+
+def row_user_id(record: Any) -> str:
+    """Идентификатор пользователя из непроверенной записи (для строки с ошибкой)"""
+    return str(record.get('userId') or '') if isinstance(record, dict) else ''
+
+def _generate_bulk_chunk(rows: List[Union[str, Dict[str, Any]]],
+                         csv_cells: bool = True) -> Tuple[List[str], int, List[Tuple[str, float, float, Dict[str, float]]]]:
+    """Валидация и генерация части пакета в воркере.
+
+    Возвращает готовые строки JSONL (BatchPlanItem), число успешных планов и времена
+    этапов для метрик. Строка JSONL приходит текстом, строка CSV - словарем ячеек
+    (csv_cells), запись пакета API - словарем полей UserData. Ошибка разбора,
+    валидации или генерации фиксируется для строки отдельно, порядок строк сохраняется.
+    """
+    generator = _worker_generator or advanced_generator
+    lines = []
+    succeeded = 0
+    observations = []
+    for row in rows:
+        user_id = ''
+        try:
+            if isinstance(row, str):
+                record = json.loads(row)
+            else:
+                record = csv_user_record(row) if csv_cells else row
+            user_id = row_user_id(record)
+            user_data = UserData.model_validate(record)
+            response = build_study_plan_response(generator, user_data)
+            item = BatchPlanItem(userId=user_data.userId, success=True, result=response)
+            analytics = response.analytics or {}
+            observations.append((response.plan.studyFocus.planType, user_data.currentScore,
+                                 analytics.get('processingTime', 0.0), analytics.get('stageTimings', {})))
+            succeeded += 1
+        except Exception as e:
+            item = BatchPlanItem(userId=user_id, success=False, error=f"{type(e).__name__}: {e}")
+        lines.append(item.model_dump_json(exclude_none=True))
+    return lines, succeeded, observations
+
+def get_plan_executor() -> Optional[Executor]:
+    """Ленивая инициализация исполнителя для одиночных запросов (None в режиме inline)"""
+    global _plan_executor
+    if PLAN_EXECUTOR_MODE == "inline":
+        return None
+    if _plan_executor is None:
+        workers = max(1, PLAN_EXECUTOR_WORKERS)
+        if PLAN_EXECUTOR_MODE == "process":
+            _plan_executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_plan_worker)
+        else:
+            _plan_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plan-generator")
+        logger.info(f"⚙️ Исполнитель генерации планов: {PLAN_EXECUTOR_MODE}, {workers} воркеров")
+    return _plan_executor
+
+def get_batch_executor() -> ProcessPoolExecutor:
+    """Ленивая инициализация пула процессов для пакетной генерации"""
+    global _batch_executor
+    if _batch_executor is None:
+        _batch_executor = ProcessPoolExecutor(
+            max_workers=max(1, BATCH_MAX_WORKERS),
+            initializer=_init_plan_worker
+        )
+        logger.info(f"⚙️ Запущен пул процессов для пакетной генерации: {BATCH_MAX_WORKERS} воркеров")
+    return _batch_executor
+
+def personalize_shared_response(shared: StudyPlanResponse, user_data: UserData, **flags: bool) -> StudyPlanResponse:
+    """Копия общего (из кэша или объединенного запроса) ответа с идентификатором плана текущего пользователя"""
+    plan_id = f"plan_{user_data.userId}_{int(utc_now().timestamp())}"
+    return shared.model_copy(update={
+        'plan': shared.plan.model_copy(update={'planId': plan_id}),
+        'planId': plan_id,
+        'analytics': {**(shared.analytics or {}), **flags}
+    })
+
+class SingleFlight:
+    """Объединение одновременных запросов с одинаковым ключом в одно вычисление"""
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Возвращает результат и признак того, что он получен от чужого вычисления"""
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+        
+        # Вычисление живет отдельной задачей: отмена первого запроса не прерывает остальных
+        task = asyncio.ensure_future(compute())
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        self.leaders += 1
+        return await asyncio.shield(task), False
+
+    def stats(self) -> Dict[str, Any]:
+        requests = self.leaders + self.coalesced
+        return {
+            'inFlight': len(self._inflight),
+            'computations': self.leaders,
+            'coalesced': self.coalesced,
+            'coalescedRate': self.coalesced / requests if requests else 0.0
+        }
+
+plan_single_flight = SingleFlight()
+
+async def run_plan_job(job: Callable[..., Any], *args: Any) -> Any:
+    """Выполняет задание в исполнителе PLAN_EXECUTOR_MODE, чтобы цикл событий занимался только вводом-выводом"""
+    executor = get_plan_executor()
+    if executor is None:
+        return job(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, job, *args)
+
+async def run_plan_generation(user_data: UserData, profile: bool = False) -> StudyPlanResponse:
+    """Генерация одного плана в исполнителе"""
+    return await run_plan_job(_profiled_generate_plan_job if profile else _generate_plan_job, user_data)
+
+def profiling_requested(request: Request, profile: bool) -> bool:
+    """Профилирование включается флагом запроса, только если оно разрешено конфигурацией"""
+    return PLAN_PROFILING_ENABLED and (
+        profile or request.headers.get("x-profile-plan", "").lower() in ("1", "true", "yes")
+    )
+
+def shutdown_plan_executors():
+    """Остановка пулов генерации без ожидания незавершенных задач"""
+    global _plan_executor, _batch_executor
+    for executor in (_plan_executor, _batch_executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    _plan_executor = None
+    _batch_executor = None
+
+def restart_process_executors():
+    """Пересоздание процессных пулов: новые воркеры перечитают SUCCESS_TABLE_PATH.
+
+    Начатые задачи дорабатывают в старых процессах, новые уходят в свежий пул.
+    """
+    global _plan_executor, _batch_executor
+    if PLAN_EXECUTOR_MODE == "process" and _plan_executor is not None:
+        _plan_executor.shutdown(wait=False)
+        _plan_executor = None
+    if _batch_executor is not None:
+        _batch_executor.shutdown(wait=False)
+        _batch_executor = None
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+MSGPACK_STRING_REF = 1  # код ext-типа MessagePack: ссылка на строку из таблицы
+
+def pack_with_string_table(payload: Any) -> bytes:
+    """MessagePack-кодирование с таблицей строк.
+
+    Результат - словарь {'strings': [...], 'data': ...}: каждая строка-значение длиной от 3 символов
+    заменяется в data на ext-тип MSGPACK_STRING_REF с индексом в strings (big-endian, 1/2/4 байта).
+    Ключи словарей остаются обычными строками. payload изменяется на месте.
+    """
+    table: List[str] = []
+    refs: Dict[str, Any] = {}
+    ext_type = msgpack.ExtType
+    
+    def ref(value: str):
+        reference = refs.get(value)
+        if reference is None:
+            index = len(table)
+            size = 1 if index < 0x100 else 2 if index < 0x10000 else 4
+            reference = refs[value] = ext_type(MSGPACK_STRING_REF, index.to_bytes(size, 'big'))
+            table.append(value)
+        return reference
+    
+    # Обход без рекурсии: контейнеры из model_dump принадлежат запросу и меняются на месте
+    stack = [payload]
+    while stack:
+        node = stack.pop()
+        items = node.items() if type(node) is dict else enumerate(node)
+        for key, value in items:
+            value_type = type(value)
+            if value_type is str:
+                if len(value) >= 3:
+                    node[key] = refs.get(value) or ref(value)
+            elif value_type is dict or value_type is list:
+                stack.append(value)
+    
+    if type(payload) is str:
+        payload = ref(payload)
+    return msgpack.packb({'strings': table, 'data': payload}, use_bin_type=True)
+
+def wants_msgpack(request: Optional[Request]) -> bool:
+    """Клиент явно запросил MessagePack в заголовке Accept"""
+    if request is None or msgpack is None:
+        return False
+    accept = request.headers.get("accept", "").lower()
+    return any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES)
+
+def plan_response(model: BaseModel, request: Optional[Request] = None) -> Response:
+    """Ответ API: MessagePack с таблицей строк, если он запрошен в Accept, иначе JSON.
+
+    Оба формата кодируются за один проход без jsonable_encoder.
+    """
+    headers = {"Vary": "Accept"}
+    if wants_msgpack(request):
+        content = pack_with_string_table(model.model_dump(mode='json', exclude_none=True))
+        return Response(content=content, media_type=MSGPACK_MEDIA_TYPES[0], headers=headers)
+    return Response(content=model.model_dump_json(exclude_none=True), media_type="application/json", headers=headers)
+
+def remember_plan(response: StudyPlanResponse, user_data: UserData) -> StudyPlanResponse:
+    """Сохраняет выданный план по planId для последующего перепланирования"""
+    plan_store.put(response.planId, StoredPlan(plan=response.plan, userData=user_data).model_dump_json().encode())
+    return response
 
 # API Endpoints
 @app.post("/generate-plan", response_model=StudyPlanResponse)
-async def generate_plan(user_data: UserData):
+async def generate_plan(user_data: UserData, request: Request, profile: bool = False):
     """Генерирует расширенный персонализированный учебный план для ЕГЭ"""
     try:
         logger.info(f"🎯 Генерация улучшенного плана для пользователя {user_data.userId}")
         logger.info(f"📊 Данные: {user_data.currentScore} → {user_data.targetScore} баллов")
         logger.info(f"🎓 Стиль обучения: {user_data.learningStyle}")
         
-        start_time = datetime.now()
+        if profiling_requested(request, profile):
+            # Профилируемый запрос всегда считается заново, мимо кэша и объединения
+            logger.info(f"🔬 Профилирование генерации плана для пользователя {user_data.userId}")
+            response = await run_plan_generation(user_data, profile=True)
+            observe_plan_response(response, user_data)
+            return plan_response(remember_plan(response, user_data), request)
         
-        plan = advanced_generator.generate_advanced_study_plan(user_data)
+        cache_key = plan_cache_key(user_data)
+        cached = plan_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"♻️ План взят из кэша для пользователя {user_data.userId}")
+            shared = StudyPlanResponse.model_validate_json(cached)
+            return plan_response(remember_plan(personalize_shared_response(shared, user_data, cacheHit=True), user_data), request)
         
-        # Генерация рекомендаций
-        recommendations = generate_smart_recommendations(user_data, plan)
+        async def compute() -> StudyPlanResponse:
+            generated = await run_plan_generation(user_data)
+            observe_plan_response(generated, user_data)
+            plan_cache.put(cache_key, generated.model_dump_json().encode())
+            return generated
         
-        processing_time = (datetime.now() - start_time).total_seconds()
-        
-        response = StudyPlanResponse(
-            success=True,
-            plan=plan,
-            recommendations=recommendations,
-            confidence=plan['analytics']['successProbability'],
-            generatedBy="advanced_ml_system_v2",
-            planId=plan['planId'],
-            analytics={
-                'processingTime': processing_time,
-                'planComplexity': 'high',
-                'personalizationLevel': 'advanced'
-            }
-        )
+        response, coalesced = await plan_single_flight.do(cache_key, compute)
+        if coalesced:
+            logger.info(f"🔗 Запрос пользователя {user_data.userId} объединен с идентичным")
+            return plan_response(remember_plan(personalize_shared_response(response, user_data, coalesced=True), user_data), request)
         
-        logger.info(f"✅ План успешно сгенерирован: {plan['durationWeeks']} недель, "
-                   f"{plan['totalTopics']} тем, уверенность: {response.confidence:.2f}")
+        logger.info(f"✅ План успешно сгенерирован: {response.plan.durationWeeks} недель, "
+                   f"{response.plan.totalTopics} тем, уверенность: {response.confidence:.2f}")
         
-        return response
+        return plan_response(remember_plan(response, user_data), request)
         
     except Exception as e:
         logger.error(f"💥 Ошибка при генерации плана: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Ошибка генерации плана: {str(e)}")
 
+@app.post("/generate-plan/stream")
+async def generate_plan_stream(user_data: UserData):
+    """Потоковая генерация плана в формате NDJSON: заголовок, недели по мере готовности, аналитика"""
+    logger.info(f"🌊 Потоковая генерация плана для пользователя {user_data.userId}")
+    start_time = time.perf_counter()
+    
+    # Заголовок считается до начала ответа, чтобы ошибки входных данных возвращались как 500
+    try:
+        if PLAN_EXECUTOR_MODE == "process":
+            # Генератор остается в воркере: план считается целиком, потоком отдаются готовые части
+            collected, spans = await run_plan_job(_stream_plan_job, user_data)
+            collected_parts = iter(collected)
+            
+            async def next_part() -> Optional[Tuple[str, Dict[str, Any]]]:
+                return next(collected_parts, None)
+        else:
+            spans = {}
+            parts = advanced_generator.iter_advanced_study_plan(user_data, spans)
+            
+            async def next_part() -> Optional[Tuple[str, Dict[str, Any]]]:
+                return await run_plan_job(next, parts, None)
+        header = await next_part()
+    except Exception as e:
+        logger.error(f"💥 Ошибка при генерации плана: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Ошибка генерации плана: {str(e)}")
+    
+    def to_line(message: Dict[str, Any]) -> bytes:
+        return (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+    
+    async def lines() -> AsyncIterator[bytes]:
+        _, header_payload = header
+        yield to_line({'type': 'header', **header_payload})
+        try:
+            while (item := await next_part()) is not None:
+                part, payload = item
+                if part == 'week':
+                    yield to_line({'type': 'week', 'week': payload})
+                else:
+                    plan = {**header_payload, **payload}
+                    stage_start = time.perf_counter()
+                    recommendations = generate_smart_recommendations(user_data, plan)
+                    spans['recommendations'] = time.perf_counter() - stage_start
+                    processing_time = time.perf_counter() - start_time
+                    observe_plan_timings(plan['studyFocus']['planType'], user_data.currentScore,
+                                         processing_time, spans)
+                    yield to_line({
+                        'type': 'analytics',
+                        **payload,
+                        'recommendations': recommendations,
+                        'confidence': payload['analytics']['successProbability'],
+                        'processingTime': processing_time
+                    })
+        except Exception as e:
+            # Статус ответа уже отправлен - сообщаем об ошибке отдельной строкой
+            logger.error(f"💥 Ошибка при потоковой генерации плана: {str(e)}", exc_info=True)
+            yield to_line({'type': 'error', 'detail': f"Ошибка генерации плана: {str(e)}"})
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.post("/generate-plan/sweep", response_model=SweepResponse)
+async def generate_plan_sweep(sweep_request: SweepRequest, request: Request):
+    """Варианты "что если" по часам в неделю и целевому баллу одним запросом"""
+    profile = sweep_request.profile
+    hours_options = list(dict.fromkeys(sweep_request.hoursPerWeek or [profile.availableHoursPerWeek]))
+    target_options = list(dict.fromkeys(sweep_request.targetScores or [profile.targetScore]))
+    variants = len(hours_options) * len(target_options)
+    if variants > SWEEP_MAX_VARIANTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком много вариантов: {variants} (максимум {SWEEP_MAX_VARIANTS})"
+        )
+    if min(hours_options) < 1:
+        raise HTTPException(status_code=400, detail="Часы в неделю должны быть положительными")
+    
+    start_time = time.perf_counter()
+    try:
+        summary = await run_plan_job(_sweep_job, profile, hours_options, target_options)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    processing_time = time.perf_counter() - start_time
+    logger.info(f"🔀 Сравнение вариантов для пользователя {profile.userId}: {variants} вариантов за {processing_time:.3f}с")
+    
+    return plan_response(SweepResponse(
+        success=True,
+        userId=profile.userId,
+        processingTime=processing_time,
+        **summary
+    ), request)
+
+def replanned_user_data(previous_user: UserData, replan_request: ReplanRequest) -> UserData:
+    """Данные ученика после нового пробного теста"""
+    test_results = {**previous_user.testResults, **replan_request.testResults}
+    current_score = replan_request.currentScore
+    if current_score is None:
+        current_score = test_results.get('estimatedScore', previous_user.currentScore)
+    update: Dict[str, Any] = {'testResults': test_results, 'currentScore': float(current_score)}
+    if replan_request.weakAreas is not None:
+        update['weakAreas'] = replan_request.weakAreas
+    if replan_request.strongAreas is not None:
+        update['strongAreas'] = replan_request.strongAreas
+    return previous_user.model_copy(update=update)
+
+def build_replan_response(generator: AdaptiveStudyPlanGenerator, previous_plan: Dict[str, Any],
+                          user_data: UserData, completed_weeks: int) -> StudyPlanResponse:
+    """Перепланирование и упаковка результата в ответ API"""
+    start_time = time.perf_counter()
+    spans: Dict[str, float] = {}
+    plan = generator.replan(previous_plan, user_data, completed_weeks, spans)
+    
+    stage_start = time.perf_counter()
+    recommendations = generate_smart_recommendations(user_data, plan)
+    spans['recommendations'] = time.perf_counter() - stage_start
+    
+    return StudyPlanResponse(
+        success=True,
+        plan=plan,
+        recommendations=recommendations,
+        confidence=plan['analytics']['successProbability'],
+        generatedBy="advanced_ml_system_v2",
+        planId=plan['planId'],
+        analytics={
+            'processingTime': time.perf_counter() - start_time,
+            'stageTimings': spans,
+            'planComplexity': 'high',
+            'personalizationLevel': 'advanced',
+            'replanned': True
+        }
+    )
+
+@app.post("/replan", response_model=StudyPlanResponse)
+async def replan(replan_request: ReplanRequest, request: Request):
+    """Перепланирование после пробного теста: пройденные недели сохраняются, пересчитывается остаток"""
+    if replan_request.planId is not None and replan_request.plan is None:
+        stored = plan_store.get(replan_request.planId)
+        if stored is None:
+            raise HTTPException(status_code=404, detail=f"План {replan_request.planId} не найден, передайте plan и userData")
+        stored = StoredPlan.model_validate_json(stored)
+        previous_plan, previous_user = stored.plan.model_dump(exclude_none=True), stored.userData
+    elif replan_request.plan is not None and replan_request.userData is not None:
+        previous_plan, previous_user = replan_request.plan.model_dump(exclude_none=True), replan_request.userData
+    else:
+        raise HTTPException(status_code=400, detail="Нужен planId или тело плана вместе с userData")
+    
+    if not 0 <= replan_request.completedWeeks <= previous_plan['durationWeeks']:
+        raise HTTPException(status_code=400, detail=f"completedWeeks должно быть от 0 до {previous_plan['durationWeeks']}")
+    
+    try:
+        user_data = replanned_user_data(previous_user, replan_request)
+        logger.info(f"🔁 Перепланирование для пользователя {user_data.userId}: "
+                    f"пройдено недель {replan_request.completedWeeks}, балл {previous_user.currentScore} → {user_data.currentScore}")
+        response = await run_plan_job(_replan_job, previous_plan, user_data, replan_request.completedWeeks)
+        return plan_response(remember_plan(response, user_data), request)
+    except Exception as e:
+        logger.error(f"💥 Ошибка при перепланировании: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Ошибка перепланирования: {str(e)}")
+
+@app.post("/generate-plans/batch")
+async def generate_plans_batch(request: BatchPlanRequest):
+    """Пакетная генерация планов в пуле процессов потоком NDJSON.
+
+    Строка на пользователя (BatchPlanItem) в порядке запроса - ошибка валидации или генерации
+    затрагивает только эту строку; последняя строка - BatchPlanSummary. В работе не больше
+    двух частей на воркер, готовые части сразу уходят клиенту и не накапливаются в памяти.
+    """
+    users = request.users
+    if len(users) > BATCH_MAX_USERS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком большой пакет: {len(users)} пользователей (максимум {BATCH_MAX_USERS})"
+        )
+    
+    logger.info(f"📦 Пакетная генерация планов для {len(users)} пользователей")
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    executor = get_batch_executor()
+    chunk_size = max(1, BATCH_CHUNK_SIZE)
+    max_inflight = 2 * max(1, BATCH_MAX_WORKERS)
+    
+    async def lines() -> AsyncIterator[bytes]:
+        inflight: deque = deque()
+        position = 0
+        succeeded = 0
+        while position < len(users) or inflight:
+            while position < len(users) and len(inflight) < max_inflight:
+                chunk = users[position:position + chunk_size]
+                inflight.append((chunk, loop.run_in_executor(executor, _generate_bulk_chunk, chunk, False)))
+                position += chunk_size
+            chunk, future = inflight.popleft()
+            try:
+                chunk_lines, chunk_succeeded, observations = await future
+            except Exception as e:
+                # Сбой воркера затрагивает всю часть пакета
+                logger.error(f"💥 Ошибка воркера пакетной генерации: {e}")
+                error = f"{type(e).__name__}: {e}"
+                chunk_lines = [
+                    BatchPlanItem(userId=row_user_id(record), success=False, error=error).model_dump_json(exclude_none=True)
+                    for record in chunk
+                ]
+                chunk_succeeded, observations = 0, []
+            for plan_type, current_score, processing_time, spans in observations:
+                observe_plan_timings(plan_type, current_score, processing_time, spans)
+            succeeded += chunk_succeeded
+            yield ('\n'.join(chunk_lines) + '\n').encode('utf-8')
+        
+        processing_time = time.perf_counter() - start_time
+        logger.info(f"✅ Пакет обработан: {succeeded}/{len(users)} планов за {processing_time:.2f}с")
+        summary = BatchPlanSummary(
+            success=succeeded == len(users),
+            total=len(users),
+            succeeded=succeeded,
+            failed=len(users) - succeeded,
+            processingTime=processing_time
+        )
+        yield (summary.model_dump_json() + '\n').encode('utf-8')
+    
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+def simulation_grid(request: SimulationRequest) -> Dict[str, Any]:
+    """Оси сетки симуляции из запроса с подстановкой значений по умолчанию"""
+    axes = {
+        'currentScore': request.currentScores,
+        'targetScore': request.targetScores,
+        'hoursPerWeek': request.hoursPerWeek,
+        'weeks': request.weeks,
+        'motivation': request.motivationLevels
+    }
+    return {name: values or SIMULATION_GRID[name] for name, values in axes.items()}
+
+@app.post("/simulate", response_model=SimulationResponse)
+async def simulate(request: SimulationRequest, x_admin_token: Optional[str] = Header(None)):
+    """Монте-Карло симуляция учеников на сетке параметров и сравнение со ступенчатой оценкой.
+
+    С activate=true (нужен X-Admin-Token) таблица сохраняется в SUCCESS_TABLE_PATH и заменяет
+    ступенчатую оценку: кэш планов сбрасывается, процессные пулы пересоздаются с новой таблицей.
+    """
+    global success_table
+    if request.activate:
+        if not SIMULATION_ACTIVATE_TOKEN or not hmac.compare_digest(
+                (x_admin_token or "").encode(), SIMULATION_ACTIVATE_TOKEN.encode()):
+            raise HTTPException(status_code=403, detail="Активация таблицы требует X-Admin-Token")
+        if not SUCCESS_TABLE_PATH:
+            raise HTTPException(status_code=409, detail="Активация таблицы требует SUCCESS_TABLE_PATH")
+    
+    grid = simulation_grid(request)
+    nodes = math.prod(len(set(axis)) for axis in grid.values())
+    if nodes > SIMULATION_MAX_NODES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком большая сетка: {nodes} узлов (максимум {SIMULATION_MAX_NODES})"
+        )
+    # Цель и горизонт не увеличивают число траекторий
+    trajectories = (len(set(grid['currentScore'])) * len(set(grid['hoursPerWeek']))
+                    * len(set(grid['motivation'])) * request.studentsPerCell)
+    if trajectories > SIMULATION_MAX_TRAJECTORIES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Слишком большая симуляция: {trajectories} траекторий (максимум {SIMULATION_MAX_TRAJECTORIES})"
+        )
+    
+    start_time = time.perf_counter()
+    try:
+        table, comparison = await run_in_threadpool(
+            run_success_simulation, grid, request.studentsPerCell, request.seed
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if request.activate:
+        await run_in_threadpool(table.save, SUCCESS_TABLE_PATH)
+        success_table = table
+        restart_process_executors()
+        removed = plan_cache.invalidate()
+        logger.info(f"🎲 Таблица симуляции активирована ({SUCCESS_TABLE_PATH}), сброшено записей кэша планов: {removed}")
+    
+    return SimulationResponse(
+        success=True,
+        gridShape={name: len(axis) for name, axis in table.axes.items()},
+        cells=int(table.values.size),
+        trajectories=trajectories,
+        stepFunction=comparison,
+        activated=request.activate,
+        processingTime=time.perf_counter() - start_time
+    )
+
 @app.get("/health")
 async def health_check():
     return {
@@ -1316,6 +3651,49 @@ async def health_check():
         "timestamp": datetime.now().isoformat()
     }
 
+@app.get("/plan-cache/stats")
+async def plan_cache_stats():
+    """Статистика кэша планов"""
+    return plan_cache.stats()
+
+@app.post("/plan-cache/invalidate")
+async def invalidate_plan_cache(user_data: Optional[UserData] = None):
+    """Сбрасывает запись кэша для профиля или весь кэш, если профиль не передан"""
+    key = plan_cache_key(user_data) if user_data is not None else None
+    removed = plan_cache.invalidate(key)
+    logger.info(f"🧹 Сброшено записей кэша планов: {removed}")
+    return {"success": True, "removed": removed}
+
+@app.get("/coalescing/stats")
+async def coalescing_stats():
+    """Статистика объединения одновременных запросов /generate-plan"""
+    return plan_single_flight.stats()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики сервиса в текстовом формате Prometheus"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+def _collect_runtime_metrics() -> List[_Metric]:
+    """Снимок счетчиков кэша и объединения запросов на момент опроса"""
+    cache_stats = plan_cache.stats()
+    flight_stats = plan_single_flight.stats()
+    snapshot = [
+        (Counter("ege_plan_cache_hits_total", "Попадания в кэш планов"), cache_stats['hits']),
+        (Counter("ege_plan_cache_misses_total", "Промахи кэша планов"), cache_stats['misses']),
+        (Counter("ege_plan_cache_evictions_total", "Вытеснения из кэша планов"), cache_stats['evictions']),
+        (Gauge("ege_plan_cache_entries", "Записей в кэше планов"), cache_stats['size']),
+        (Gauge("ege_plan_cache_bytes", "Объем сериализованных планов в кэше"), cache_stats['bytes']),
+        (Counter("ege_plan_computations_total", "Запущенные генерации планов /generate-plan"), flight_stats['computations']),
+        (Counter("ege_plan_coalesced_requests_total", "Запросы, объединенные с идентичным"), flight_stats['coalesced']),
+        (Gauge("ege_plan_computations_in_flight", "Генерации планов в процессе"), flight_stats['inFlight'])
+    ]
+    for metric, value in snapshot:
+        metric.inc(amount=value)
+    return [metric for metric, _ in snapshot]
+
+metrics.register_collector(_collect_runtime_metrics)
+
 @app.get("/topics")
 async def get_topics():
     """Возвращает все доступные темы"""
@@ -1352,6 +3730,132 @@ def generate_smart_recommendations(user_data: UserData, plan: Dict) -> List[str]
     
     return recommendations[:5]  # Возвращаем 5 самых важных рекомендаций
 
+def _axis_argument(value: str) -> List[float]:
+    return [float(item) for item in value.split(',') if item.strip()]
+
+def run_simulation_cli(args) -> int:
+    """Офлайн-симуляция: таблица сохраняется в .npz для SUCCESS_TABLE_PATH"""
+    axes = {
+        'currentScore': args.current_scores,
+        'targetScore': args.target_scores,
+        'hoursPerWeek': args.hours,
+        'weeks': args.weeks,
+        'motivation': args.motivation
+    }
+    grid = {name: values or SIMULATION_GRID[name] for name, values in axes.items()}
+    start_time = time.perf_counter()
+    try:
+        table, comparison = run_success_simulation(grid, args.students, args.seed)
+    except ValueError as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return 2
+    table.save(args.out)
+    
+    print(f"Таблица {args.out}: оси {dict((name, len(axis)) for name, axis in table.axes.items())}, "
+          f"{args.students} учеников на точку, {time.perf_counter() - start_time:.2f}с")
+    print(f"Ступенчатая оценка: MAE {comparison['meanAbsoluteError']:.3f}, "
+          f"смещение {comparison['bias']:+.3f}, максимум {comparison['maxAbsoluteError']:.3f}")
+    for row in comparison['calibration']:
+        print(f"  оценка {row['predicted']:.2f} -> симуляция {row['simulated']:.3f} ({row['cells']} узлов)")
+    return 0
+
+def iter_bulk_rows(path: str, read_rows: int = BULK_READ_ROWS) -> Iterator[Union[str, Dict[str, Any]]]:
+    """Потоковое чтение выгрузки: JSONL - строками текста, CSV - словарями ячеек частями по read_rows"""
+    if path.lower().endswith('.csv'):
+        import pandas as pd
+        # Все ячейки читаются строками: типы приводит валидация UserData
+        with pd.read_csv(path, chunksize=read_rows, dtype=str, keep_default_na=False) as reader:
+            for frame in reader:
+                yield from frame.to_dict('records')
+    else:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield line
+
+def run_bulk_cli(args) -> int:
+    """Офлайн-генерация планов из выгрузки CSV/JSONL в JSONL (строка результата на строку входа).
+
+    Части по chunk_size строк уходят в пул процессов; одновременно в работе не больше
+    max_inflight частей, результаты пишутся по порядку входа, поэтому память не растет с размером файла.
+    """
+    workers = max(1, args.workers)
+    chunk_size = max(1, args.chunk_size)
+    max_inflight = max(1, args.max_inflight or 2 * workers)
+    rows = iter_bulk_rows(args.input)
+    inflight: deque = deque()
+    processed = succeeded = 0
+    start_time = last_report = time.perf_counter()
+    
+    def report(final: bool = False):
+        elapsed = time.perf_counter() - start_time
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        prefix = "Готово" if final else "Обработано"
+        print(f"{prefix}: {processed} строк, {succeeded} планов, {processed - succeeded} ошибок, "
+              f"{elapsed:.1f}с, {rate:.1f} строк/с", file=sys.stderr)
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_bulk_worker) as executor, \
+            open(args.out, 'w', encoding='utf-8') as out:
+        
+        def write_oldest():
+            nonlocal processed, succeeded, last_report
+            lines, chunk_succeeded, _ = inflight.popleft().result()
+            out.write('\n'.join(lines))
+            out.write('\n')
+            processed += len(lines)
+            succeeded += chunk_succeeded
+            if time.perf_counter() - last_report >= args.progress_every:
+                last_report = time.perf_counter()
+                report()
+        
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            if len(inflight) >= max_inflight:
+                write_oldest()
+            inflight.append(executor.submit(_generate_bulk_chunk, chunk))
+        while inflight:
+            write_oldest()
+    
+    report(final=True)
+    return 0
+
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Advanced EGE ML Generator v2")
+    commands = parser.add_subparsers(dest="command")
+    serve_parser = commands.add_parser("serve", help="запуск API (по умолчанию)")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    
+    simulate_parser = commands.add_parser("simulate", help="Монте-Карло таблица вероятности успеха")
+    simulate_parser.add_argument("--out", default=SUCCESS_TABLE_PATH or "success_table.npz")
+    simulate_parser.add_argument("--students", type=int, default=SIMULATION_STUDENTS,
+                                 help="смоделированных учеников на точку сетки")
+    simulate_parser.add_argument("--seed", type=int, default=0)
+    simulate_parser.add_argument("--current-scores", type=_axis_argument, help="ось через запятую, например 10,30,50")
+    simulate_parser.add_argument("--target-scores", type=_axis_argument)
+    simulate_parser.add_argument("--hours", type=_axis_argument)
+    simulate_parser.add_argument("--weeks", type=_axis_argument)
+    simulate_parser.add_argument("--motivation", type=_axis_argument)
+    
+    bulk_parser = commands.add_parser("bulk", help="офлайн-генерация планов из выгрузки CSV/JSONL")
+    bulk_parser.add_argument("input", help="файл .csv или .jsonl с полями UserData")
+    bulk_parser.add_argument("--out", required=True, help="файл результатов JSONL")
+    bulk_parser.add_argument("--workers", type=int, default=BATCH_MAX_WORKERS)
+    bulk_parser.add_argument("--chunk-size", type=int, default=BATCH_CHUNK_SIZE,
+                             help="строк в одной задаче воркера")
+    bulk_parser.add_argument("--max-inflight", type=int, default=0,
+                             help="задач в работе одновременно (по умолчанию 2 на воркер)")
+    bulk_parser.add_argument("--progress-every", type=float, default=5.0,
+                             help="интервал отчета о прогрессе, секунд")
+    args = parser.parse_args()
+    
+    if args.command == "simulate":
+        raise SystemExit(run_simulation_cli(args))
+    if args.command == "bulk":
+        raise SystemExit(run_bulk_cli(args))
+    
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
\ No newline at end of file
+    uvicorn.run(app, host=getattr(args, "host", "0.0.0.0"), port=getattr(args, "port", 8000), log_level="info")
\ No newline at end of file
@@ -0,0 +1,89 @@
+"""Золотые тесты распределения часов по темам и недельного плана.
+
+Профили и ожидаемые планы лежат в fixtures/. golden-011, golden-048, golden-053 и golden-058
+попадают на целую границу доли часов, где нарастающая сумма приоритетов без пересчета
+дала бы другое расписание. После намеренного изменения алгоритма ожидаемые планы пересобираются:
+    python tests/test_golden_plans.py
+"""
+import json
+import logging
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main
+
+FIXTURES = Path(__file__).parent / "fixtures"
+PROFILES_PATH = FIXTURES / "golden_profiles.json"
+PLANS_PATH = FIXTURES / "golden_plans.json"
+# Фиксированное "сейчас": от него считаются недели до экзамена и даты плана
+NOW = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def build_golden(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Распределение часов и недели плана для профиля, в виде JSON"""
+    generator = main.advanced_generator
+    ctx = generator.build_context(main.UserData(**profile), NOW)
+    schedule = generator.optimize_topic_selection(ctx)
+    # Распределение фиксируется до упаковки: упаковка дописывает week_distribution
+    topics = json.loads(json.dumps(schedule, ensure_ascii=False))
+    if ctx.advanced:
+        weeks = generator.iter_focused_weekly_plan(schedule, ctx)
+    else:
+        weeks = generator.iter_personalized_weekly_plan(schedule, ctx)
+    # От распределения зависят темы, часы и ресурсы недели; тексты заданий - шаблонные
+    return {
+        'topicDistribution': topics,
+        'weeklySchedule': [
+            {
+                'weekNumber': week['weekNumber'],
+                'totalHours': week['totalHours'],
+                'focusTopics': [[topic['name'], topic['hours']] for topic in week['focusTopics']],
+                'resources': week['resources']
+            }
+            for week in weeks
+        ]
+    }
+
+
+PROFILES = json.loads(PROFILES_PATH.read_text(encoding="utf-8"))
+
+
+@pytest.fixture(scope="module")
+def expected_plans() -> Dict[str, Any]:
+    return json.loads(PLANS_PATH.read_text(encoding="utf-8"))
+
+
+@pytest.mark.parametrize("profile", PROFILES, ids=[profile['userId'] for profile in PROFILES])
+def test_golden_plan(profile, expected_plans):
+    assert build_golden(profile) == expected_plans[profile['userId']]
+
+
+def test_last_candidate_gets_whole_remainder():
+    """После вычитаний нарастающая сумма равна 17.600000000000005 вместо 17.6:
+    без пересчета суммы у целой границы последняя тема получила бы 8 часов из 9"""
+    analysis = {
+        name: main.TopicScore(
+            record=main.TopicRecord(name=name, category='Алгебра', weight=0.1, base_time=4, complexity=2,
+                                    importance='medium', categories=('Алгебра',)),
+            priority=priority,
+            estimated_time=12
+        )
+        for name, priority in (('a', 17.6), ('b', 24.0), ('c', 20.8))
+    }
+    allocator = main.TopicAllocator(analysis, 28, False, [], main.advanced_generator.dependency_graph)
+    schedule = allocator.allocate()
+    assert {name: info['allocated_hours'] for name, info in schedule.items()} == {'b': 10, 'c': 9, 'a': 9}
+    assert allocator.remaining_hours == 0
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    plans = {profile['userId']: build_golden(profile) for profile in PROFILES}
+    PLANS_PATH.write_text(json.dumps(plans, ensure_ascii=False, indent=1) + "\n", encoding="utf-8")
+    print(f"Записано {len(plans)} планов в {PLANS_PATH}")
@@ -42,7 +42,7 @@ export async function POST(request: NextRequest) {
         
         return NextResponse.json({
           success: true,
-          plan: mlResult.plan,
+          plan: resolvePlanResources(mlResult.plan),
           recommendations: mlResult.recommendations,
           confidence: mlResult.confidence,
           generatedBy: 'ml_system'
@@ -77,6 +77,19 @@ export async function POST(request: NextRequest) {
   }
 }
 
+// ML-план хранит в неделях идентификаторы ресурсов, названия лежат в resourceCatalog
+function resolvePlanResources(plan: any) {
+  const catalog: Record<string, string> = plan?.resourceCatalog || {};
+  if (!Array.isArray(plan?.weeklySchedule)) return plan;
+  return {
+    ...plan,
+    weeklySchedule: plan.weeklySchedule.map((week: any) => ({
+      ...week,
+      resources: (week.resources || []).map((id: string) => catalog[id] ?? id)
+    }))
+  };
+}
+
 // Локальный генератор как fallback
 async function generateLocalPlan(userData: any) {
   const { localPlanGenerator } = await import('@/lib/services/localPlanGenerator');